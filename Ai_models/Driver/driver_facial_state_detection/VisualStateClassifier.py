@@ -2,11 +2,8 @@ class VisualStateClassifier:
     def __init__(self):
         print("Initializing Visual State Classifier...")
         
-        # Initialize MediaPipe for face detection and landmarks
-        self.face_detection = mp.solutions.face_detection.FaceDetection(
-            model_selection=0, min_detection_confidence=0.7
-        )
-        
+        # MediaPipe face mesh: in video mode it tracks the face from the previous
+        # frame's landmarks and only runs its face detector when tracking is lost
         self.face_mesh = mp.solutions.face_mesh.FaceMesh(
             static_image_mode=False,
             max_num_faces=1,
@@ -24,6 +21,9 @@ class VisualStateClassifier:
             'right': [362, 385, 387, 263, 373, 380]  # Right eye landmarks
         }
         
+        # Emotion crop: padding around the landmark box, as a fraction of its size
+        self.face_crop_margin = 0.2
+        
         # Blink detection
         self.eye_history = deque(maxlen=10)
         self.blink_counter = 0
@@ -131,15 +131,38 @@ class VisualStateClassifier:
             'yawning': mar > 0.7
         }
     
+    def extract_aligned_face(self, frame, landmarks):
+        """Crop the face from the mesh landmarks, rotated so the eyes are level"""
+        h, w = frame.shape[:2]
+        points = np.array([[lm.x * w, lm.y * h] for lm in landmarks], dtype=np.float32)
+        
+        # Roll angle from the outer eye corners
+        left_eye, right_eye = points[33], points[263]
+        angle = np.degrees(np.arctan2(right_eye[1] - left_eye[1], right_eye[0] - left_eye[0]))
+        center = points.mean(axis=0)
+        rotation = cv2.getRotationMatrix2D((float(center[0]), float(center[1])), float(angle), 1.0)
+        aligned = cv2.warpAffine(frame, rotation, (w, h))
+        
+        # Bounding box of the rotated landmarks, padded
+        rotated = points @ rotation[:, :2].T + rotation[:, 2]
+        x0, y0 = rotated.min(axis=0)
+        x1, y1 = rotated.max(axis=0)
+        pad_x = (x1 - x0) * self.face_crop_margin
+        pad_y = (y1 - y0) * self.face_crop_margin
+        x0, y0 = max(int(x0 - pad_x), 0), max(int(y0 - pad_y), 0)
+        x1, y1 = min(int(x1 + pad_x), w), min(int(y1 + pad_y), h)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        return aligned[y0:y1, x0:x1]
+    
     def process_frame(self, frame):
         """Process a single frame and extract visual features"""
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         
-        # Face detection with MediaPipe
-        face_results = self.face_detection.process(rgb_frame)
+        # One face localization per frame: the mesh tracker (re-detects only after losing the face)
         mesh_results = self.face_mesh.process(rgb_frame)
         
-        if not face_results.detections or not mesh_results.multi_face_landmarks:
+        if not mesh_results.multi_face_landmarks:
             return {'face_detected': False}
         
         landmarks = mesh_results.multi_face_landmarks[0].landmark
@@ -149,13 +172,16 @@ class VisualStateClassifier:
         head_pose = self.analyze_head_pose(landmarks)
         mouth_state = self.detect_yawn(landmarks)
         
-        # Emotion analysis with DeepFace
+        # Emotion analysis with DeepFace on the aligned crop; its own detector is skipped
         try:
+            face_crop = self.extract_aligned_face(frame, landmarks)
+            if face_crop is None:
+                raise ValueError("face crop is empty")
             emotion_analysis = DeepFace.analyze(
-                frame, 
+                face_crop, 
                 actions=['emotion'], 
                 enforce_detection=False,
-                detector_backend='opencv'
+                detector_backend='skip'
             )
             emotions = emotion_analysis[0]['emotion']
         except Exception as e:
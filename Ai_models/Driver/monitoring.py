@@ -1,5 +1,37 @@
-class DriverMonitoringSystem:
+class LatestFrameMailbox:
+    """Single-slot hand-off from capture to inference: a newer frame replaces an unread one"""
     def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._captured_at = None
+        self._seq = 0
+        self.frames_captured = 0
+        self.frames_dropped = 0  # overwritten before any inference worker took them
+    
+    def put(self, frame, captured_at):
+        with self._condition:
+            if self._frame is not None:
+                self.frames_dropped += 1
+            self._frame = frame
+            self._captured_at = captured_at
+            self._seq += 1
+            self.frames_captured += 1
+            self._condition.notify()
+    
+    def get(self, timeout=None):
+        """Take the newest frame as (frame, captured_at, seq), or None after `timeout` seconds"""
+        with self._condition:
+            if self._frame is None:
+                self._condition.wait(timeout)
+            if self._frame is None:
+                return None
+            item = (self._frame, self._captured_at, self._seq)
+            self._frame = None
+            return item
+
+
+class DriverMonitoringSystem:
+    def __init__(self, visual_workers=1):
         print("Initializing Driver Monitoring System...")
         
         # Initialize all components
@@ -8,7 +40,9 @@ class DriverMonitoringSystem:
         self.driving_pipeline = DrivingBehaviorAnalyzer()
         self.fusion_gateway = DriverStateFusionGateway()
         
-        # Processing queues
+        # Processing queues; camera frames go through a latest-frame mailbox instead
+        self.frame_mailbox = LatestFrameMailbox()
+        self.visual_workers = visual_workers
         self.video_queue = Queue(maxsize=5)
         self.audio_queue = Queue(maxsize=3)
         self.driving_queue = Queue(maxsize=10)
@@ -18,24 +52,33 @@ class DriverMonitoringSystem:
         self.is_running = False
         self.processing_threads = []
         
+        # Visual pipeline counters (see get_frame_stats)
+        self.stats_lock = threading.Lock()
+        self.frames_analyzed = 0
+        self.stale_results = 0
+        self.results_dropped = 0
+        self.last_visual_seq = 0
+        self.visual_latency = None
+        
         print("Driver Monitoring System ready!")
     
     def start_camera_capture(self, camera_id=0):
-        """Start camera capture thread"""
+        """Start camera capture thread (capture only; inference runs in start_visual_inference)"""
         def camera_worker():
             cap = cv2.VideoCapture(camera_id)
             cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
             cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
             
             while self.is_running:
+                # cap.read() blocks until the next frame, so this loop runs at the camera rate
                 ret, frame = cap.read()
-                if ret and not self.video_queue.full():
-                    # Resize for faster processing
-                    frame = cv2.resize(frame, (320, 240))
-                    visual_scores = self.visual_pipeline.process_frame(frame)
-                    self.video_queue.put(visual_scores)
-                
-                time.sleep(0.1)
+                if not ret:
+                    time.sleep(0.01)
+                    continue
+                captured_at = time.monotonic()
+                # Resize for faster processing
+                frame = cv2.resize(frame, (320, 240))
+                self.frame_mailbox.put(frame, captured_at)
             
             cap.release()
         
@@ -44,6 +87,63 @@ class DriverMonitoringSystem:
         thread.start()
         self.processing_threads.append(thread)
     
+    def start_visual_inference(self):
+        """Start visual inference workers, each analysing the newest captured frame"""
+        def inference_worker(classifier):
+            while self.is_running:
+                item = self.frame_mailbox.get(timeout=0.5)
+                if item is None:
+                    continue
+                frame, captured_at, seq = item
+                try:
+                    visual_scores = classifier.process_frame(frame)
+                except Exception as e:
+                    print(f"Visual inference error: {e}")
+                    continue
+                
+                with self.stats_lock:
+                    self.frames_analyzed += 1
+                    # with several workers a slow frame can finish after a newer one
+                    if seq < self.last_visual_seq:
+                        self.stale_results += 1
+                        continue
+                    self.last_visual_seq = seq
+                    self.visual_latency = time.monotonic() - captured_at
+                    self.publish_visual_scores(visual_scores)
+        
+        for i in range(self.visual_workers):
+            # the classifier keeps tracking and blink history, so workers do not share one
+            classifier = self.visual_pipeline if i == 0 else VisualStateClassifier()
+            thread = threading.Thread(target=inference_worker, args=(classifier,))
+            thread.daemon = True
+            thread.start()
+            self.processing_threads.append(thread)
+    
+    def publish_visual_scores(self, visual_scores):
+        """Queue visual scores for fusion, evicting the oldest result when fusion falls behind"""
+        while True:
+            try:
+                self.video_queue.put_nowait(visual_scores)
+                return
+            except Full:
+                try:
+                    self.video_queue.get_nowait()
+                    self.results_dropped += 1
+                except Empty:
+                    pass
+    
+    def get_frame_stats(self):
+        """Capture and inference counters of the visual pipeline"""
+        with self.stats_lock:
+            return {
+                'frames_captured': self.frame_mailbox.frames_captured,
+                'frames_dropped': self.frame_mailbox.frames_dropped,
+                'frames_analyzed': self.frames_analyzed,
+                'stale_results': self.stale_results,
+                'results_dropped': self.results_dropped,
+                'visual_latency': self.visual_latency
+            }
+    
     def start_audio_capture(self):
         """Start audio capture thread (simulated)"""
         def audio_worker():
@@ -116,8 +216,12 @@ class DriverMonitoringSystem:
         confidence = driver_state['confidence']
         alert_level = driver_state['alert_level']
         
+        frame_stats = self.get_frame_stats()
+        
         print(f"\rDriver State: {state.upper()} ({confidence:.2f}) | Alert: {alert_level} | "
-              f"Actions: {', '.join(driver_state['recommended_action'])}", end="")
+              f"Actions: {', '.join(driver_state['recommended_action'])} | "
+              f"Frames: {frame_stats['frames_analyzed']}/{frame_stats['frames_captured']} "
+              f"(dropped {frame_stats['frames_dropped']})", end="")
     
     def start_monitoring(self):
         """Start the complete monitoring system"""
@@ -126,6 +230,7 @@ class DriverMonitoringSystem:
         
         # Start all capture threads
         self.start_camera_capture()
+        self.start_visual_inference()
         self.start_audio_capture()
         self.start_driving_data_capture()
         self.start_fusion_processing()
@@ -0,0 +1,129 @@
+"""Admission control for the ingest endpoints.
+
+Three limits protect the single SQLite writer from bursts:
+- a token bucket per device (`rate` events/s refilled, up to `burst`), so one
+  flooding device cannot starve the rest of the fleet;
+- a global cap on ingest requests in flight, which bounds queueing (and so
+  tail latency) when the whole fleet reconnects at once;
+- a cap on rows waiting in the write-behind queue, which also covers
+  ``durability=async`` requests that return before their rows are written.
+A request over any limit raises RateLimited, answered with 429 and a
+Retry-After telling the device when to come back.
+"""
+import math
+import os
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict
+
+DEVICE_RATE = float(os.environ.get("SAFENET_DEVICE_RATE", "20"))
+DEVICE_BURST = float(os.environ.get("SAFENET_DEVICE_BURST", "500"))
+MAX_INFLIGHT = int(os.environ.get("SAFENET_MAX_INFLIGHT", "256"))
+MAX_QUEUED_ROWS = int(os.environ.get("SAFENET_MAX_QUEUED_ROWS", "20000"))
+MAX_TRACKED_DEVICES = 100_000
+TOP_REJECTED = 20
+
+
+class RateLimited(Exception):
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f"{limit} limit exceeded, retry after {retry_after:.1f}s")
+        self.limit = limit
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class AdmissionController:
+    def __init__(self, rate: float = DEVICE_RATE, burst: float = DEVICE_BURST, max_inflight: int = MAX_INFLIGHT,
+                 max_queued_rows: int = MAX_QUEUED_ROWS):
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.max_queued_rows = max_queued_rows
+        self.inflight = 0
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.admitted = 0
+        self.rejected: Counter = Counter()
+        self.rejected_devices: Counter = Counter()
+
+    def _bucket(self, device_id: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(device_id)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self._buckets[device_id] = bucket
+            if len(self._buckets) > MAX_TRACKED_DEVICES:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(device_id)
+            bucket.refill(self.rate, self.burst, now)
+        return bucket
+
+    def admit(self, costs: Dict[str, float]) -> None:
+        """Charge `costs` (events per device) or raise RateLimited without charging anything.
+
+        A cost above the burst size is admitted on a full bucket and leaves it
+        in debt, so large offline backlogs still get through, at `rate`.
+        """
+        now = time.monotonic()
+        buckets = {device_id: self._bucket(device_id, now) for device_id in costs}
+        for device_id, cost in costs.items():
+            bucket = buckets[device_id]
+            needed = min(cost, self.burst)
+            if bucket.tokens < needed:
+                self.rejected["device_rate"] += 1
+                self.rejected_devices[device_id] += 1
+                if len(self.rejected_devices) > MAX_TRACKED_DEVICES:
+                    self.rejected_devices = Counter(dict(self.rejected_devices.most_common(TOP_REJECTED)))
+                raise RateLimited("device_rate", (needed - bucket.tokens) / self.rate)
+        for device_id, cost in costs.items():
+            buckets[device_id].tokens -= cost
+        self.admitted += 1
+
+    def check_queue(self, queued_rows: int, rows: int) -> None:
+        """Raise RateLimited if `rows` more would overfill the write-behind queue.
+
+        An empty queue always accepts, so one batch above the cap is not refused forever.
+        """
+        if queued_rows and queued_rows + rows > self.max_queued_rows:
+            self.rejected["queue"] += 1
+            raise RateLimited("queue", 1.0)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the `max_inflight` global ingest slots for the duration."""
+        if self.inflight >= self.max_inflight:
+            self.rejected["inflight"] += 1
+            raise RateLimited("inflight", 1.0)
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+
+    def stats(self) -> Dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "max_queued_rows": self.max_queued_rows,
+            "device_rate": self.rate,
+            "device_burst": self.burst,
+            "tracked_devices": len(self._buckets),
+            "top_rejected_devices": dict(self.rejected_devices.most_common(TOP_REJECTED)),
+        }
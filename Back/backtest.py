@@ -0,0 +1,372 @@
+"""Replay stored events through two rulesets and diff the severities.
+
+Events are read in chunks, either from the event partitions of every shard
+(the typed feature columns only, no payload decoding) or from JSONL dumps,
+and scored with the old and the new ruleset in a pool of worker processes.
+Device rule overrides stored in the database apply on top of both. The
+output has one row per (device, day): how many events fell in each severity
+under each ruleset, and how many were escalated or downgraded.
+
+    python backtest.py --new rules.next.json
+    python backtest.py --old rules.json --new rules.next.json --jsonl dump-*.jsonl --out diff.csv
+    python backtest.py --new rules.next.json --rewrite
+
+`--rewrite` (run it with the API stopped, like `rollups.py rebuild`) rescores
+stored Incident rows in place with the new ruleset, deletes those that drop
+to "none" (acknowledged ones are kept unchanged) and rebuilds the rollups.
+Incidents whose payload cannot be scored are skipped. Events that would newly
+become incidents are counted in the diff but not inserted.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from rules import RULES_FILE, SEVERITY_LEVELS, RuleSet, compute_risk_batch_tolerant, extract_features_tolerant
+
+CHUNK_ROWS = 50_000
+LEVELS = len(SEVERITY_LEVELS)
+
+# (device_id, day) -> LEVELS x LEVELS counts of (old severity, new severity)
+Transitions = Dict[Tuple[str, str], np.ndarray]
+
+_old: Optional[RuleSet] = None
+_new: Optional[RuleSet] = None
+_device_rules: Dict[str, Tuple[RuleSet, RuleSet]] = {}
+
+
+def _init_worker(old_definition: Dict, new_definition: Dict, overrides: Dict[str, Dict]) -> None:
+    global _old, _new, _device_rules
+    _old, _new = RuleSet(old_definition), RuleSet(new_definition)
+    _device_rules = {dev: (_old.with_overrides(o), _new.with_overrides(o)) for dev, o in overrides.items()}
+
+
+def _codes(devices: np.ndarray, features: Tuple[np.ndarray, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """Old and new severity codes for one chunk, with device overrides applied."""
+    old = _old.severity_codes(_old.score_arrays(*features))
+    new = _new.severity_codes(_new.score_arrays(*features))
+    for dev in set(_device_rules).intersection(devices.tolist()):
+        mask = devices == dev
+        dev_old, dev_new = _device_rules[dev]
+        subset = tuple(col[mask] for col in features)
+        old[mask] = dev_old.severity_codes(dev_old.score_arrays(*subset))
+        new[mask] = dev_new.severity_codes(dev_new.score_arrays(*subset))
+    return old, new
+
+
+def _transitions(keys: np.ndarray, old: np.ndarray, new: np.ndarray) -> Dict[str, np.ndarray]:
+    """Transition counts per distinct key, vectorized with one bincount."""
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse * LEVELS * LEVELS + old * LEVELS + new, minlength=len(uniq) * LEVELS * LEVELS)
+    counts = counts.reshape(len(uniq), LEVELS, LEVELS)
+    return {key: counts[i] for i, key in enumerate(uniq.tolist())}
+
+
+def score_columns(day: str, devices: List[str], eye, dis, vms, speed) -> Transitions:
+    """Worker task: one chunk of typed columns from a single day's partition."""
+    devices = np.asarray(devices, dtype=object)
+    features = tuple(np.asarray(col, dtype=np.float64) for col in (eye, dis, vms, speed))
+    old, new = _codes(devices, features)
+    return {(dev, day): counts for dev, counts in _transitions(devices, old, new).items()}
+
+
+def score_lines(lines: List[str]) -> Tuple[Transitions, int]:
+    """Worker task: a chunk of JSONL lines; returns transitions and the number of unreadable lines."""
+    events, keys, bad = [], [], 0
+    for line in lines:
+        try:
+            event = json.loads(line)
+            device_id = str(event["device_id"])
+            day = datetime.fromisoformat(str(event["timestamp"]).replace("Z", "+00:00")).date().isoformat()
+        except (ValueError, KeyError, TypeError):
+            bad += 1
+            continue
+        events.append(event)
+        keys.append(f"{device_id}\x00{day}")
+    features, usable, errors = extract_features_tolerant(events)
+    bad += len(errors)
+    if not usable:
+        return {}, bad
+    keys = np.asarray(keys)[usable]
+    devices = np.asarray([k.split("\x00", 1)[0] for k in keys.tolist()], dtype=object)
+    old, new = _codes(devices, features)
+    return {tuple(key.split("\x00", 1)): counts for key, counts in _transitions(keys, old, new).items()}, bad
+
+
+def _merge(total: Transitions, part: Transitions) -> None:
+    for key, counts in part.items():
+        if key in total:
+            total[key] += counts
+        else:
+            total[key] = counts.copy()
+
+
+def _db_chunks(from_ts: Optional[datetime], to_ts: Optional[datetime], devices: Optional[List[str]],
+               chunk_rows: int) -> Iterator[tuple]:
+    import eventstore
+    from db import shard_engines
+    from sqlalchemy import select
+
+    for engine in shard_engines:
+        for name in eventstore.partitions_between(engine, from_ts, to_ts):
+            table = eventstore.partition_table(name)
+            day = eventstore.partition_day(name).isoformat()
+            q = select(table.c.device_id, table.c.eye_closed, table.c.distracted,
+                       table.c.vehicle_model_score, table.c.speed)
+            if from_ts is not None:
+                q = q.where(table.c.timestamp >= from_ts)
+            if to_ts is not None:
+                q = q.where(table.c.timestamp <= to_ts)
+            if devices:
+                q = q.where(table.c.device_id.in_(devices))
+            with engine.connect() as conn:
+                result = conn.execution_options(stream_results=True, yield_per=chunk_rows).execute(q)
+                while True:
+                    rows = result.fetchmany(chunk_rows)
+                    if not rows:
+                        break
+                    yield (score_columns, (day, *map(list, zip(*rows))), len(rows))
+
+
+def _jsonl_chunks(paths: List[str], chunk_rows: int) -> Iterator[tuple]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = []
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                if len(lines) >= chunk_rows:
+                    yield (score_lines, (lines,), len(lines))
+                    lines = []
+            if lines:
+                yield (score_lines, (lines,), len(lines))
+
+
+def _load_overrides() -> Dict[str, Dict]:
+    from sqlmodel import Session, select
+
+    from db import engine
+    from models import Device
+
+    overrides = {}
+    with Session(engine) as session:
+        for dev_id, config in session.exec(select(Device.device_id, Device.config).where(Device.config.isnot(None))):
+            try:
+                rules = json.loads(config).get("rules")
+            except (ValueError, AttributeError):
+                continue
+            if rules:
+                overrides[dev_id] = rules
+    return overrides
+
+
+def run(chunks: Iterator[tuple], old: RuleSet, new: RuleSet, overrides: Dict[str, Dict], workers: int,
+        progress: bool = True) -> Tuple[Transitions, int, int]:
+    """Score every chunk in the pool; returns (transitions, events read, unreadable lines)."""
+    total: Transitions = {}
+    read = bad = 0
+    started = last_report = time.monotonic()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(old.definition, new.definition, overrides)) as pool:
+        pending = deque()
+
+        def collect(fut) -> None:
+            nonlocal bad
+            result = fut.result()
+            if isinstance(result, tuple):
+                result, skipped = result
+                bad += skipped
+            _merge(total, result)
+
+        for fn, args, n in chunks:
+            # bounded read-ahead keeps memory flat on any history size
+            if len(pending) >= workers * 2:
+                collect(pending.popleft())
+            pending.append(pool.submit(fn, *args))
+            read += n
+            now = time.monotonic()
+            if progress and now - last_report >= 5:
+                last_report = now
+                print(f"  {read} events, {read / (now - started):,.0f}/s", file=sys.stderr, flush=True)
+        while pending:
+            collect(pending.popleft())
+    return total, read, bad
+
+
+def diff_rows(total: Transitions, changes_only: bool = False) -> List[Dict]:
+    rows = []
+    for (device_id, day), counts in sorted(total.items()):
+        escalated = int(np.triu(counts, 1).sum())
+        downgraded = int(np.tril(counts, -1).sum())
+        if changes_only and not (escalated or downgraded):
+            continue
+        old_counts, new_counts = counts.sum(axis=1), counts.sum(axis=0)
+        row = {"device_id": device_id, "day": day, "events": int(counts.sum())}
+        row.update({f"old_{level}": int(old_counts[i]) for i, level in enumerate(SEVERITY_LEVELS)})
+        row.update({f"new_{level}": int(new_counts[i]) for i, level in enumerate(SEVERITY_LEVELS)})
+        row.update(escalated=escalated, downgraded=downgraded,
+                   incident_delta=int(new_counts[1:].sum() - old_counts[1:].sum()))
+        rows.append(row)
+    return rows
+
+
+def write_rows(rows: List[Dict], out: Optional[str]) -> None:
+    fields = (["device_id", "day", "events"] + [f"old_{lv}" for lv in SEVERITY_LEVELS]
+              + [f"new_{lv}" for lv in SEVERITY_LEVELS] + ["escalated", "downgraded", "incident_delta"])
+    if out and out.endswith(".json"):
+        Path(out).write_text(json.dumps(rows, indent=1))
+        return
+    f = open(out, "w", newline="") if out else sys.stdout
+    try:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out:
+            f.close()
+
+
+def _score_members(members: List[Tuple[object, Dict]], ruleset: RuleSet) -> Tuple[List, int]:
+    """[(member, score, severity)] for the scorable (row, event) members, and how many were not."""
+    scored, scores, severities, errors = compute_risk_batch_tolerant([event for _, event in members], ruleset)
+    return [(members[pos], score, severity) for pos, score, severity in zip(scored, scores, severities)], len(errors)
+
+
+def rewrite_incidents(new: RuleSet, overrides: Dict[str, Dict], chunk_rows: int = 5000) -> Tuple[int, int, int, int]:
+    """Rescore stored incidents with `new`.
+
+    Returns (rows updated, rows deleted, acknowledged rows kept although they
+    fall to "none", rows skipped because their payload cannot be scored).
+    """
+    from sqlalchemy import bindparam, delete, select, update
+    from sqlmodel import Session
+
+    import rollups
+    from db import IN_CLAUSE_CHUNK, shard_engines
+    from models import Incident
+
+    device_rules = {dev: new.with_overrides(o) for dev, o in overrides.items()}
+    table = Incident.__table__
+    stmt = (update(table).where(table.c.id == bindparam("b_id"))
+            .values(score=bindparam("b_score"), severity=bindparam("b_severity"),
+                    ruleset_version=bindparam("b_version")))
+    updated = deleted = kept = skipped = 0
+    try:
+        for engine in shard_engines:
+            last_id = 0
+            while True:
+                with Session(engine) as session:
+                    rows = session.execute(
+                        select(table.c.id, table.c.device_id, table.c.payload, table.c.score, table.c.severity,
+                               table.c.ruleset_version, table.c.acked_at)
+                        .where(table.c.id > last_id).order_by(table.c.id).limit(chunk_rows)
+                    ).all()
+                    if not rows:
+                        break
+                    last_id = rows[-1].id
+                    groups: Dict[str, Tuple[RuleSet, List]] = {}
+                    for row in rows:
+                        try:
+                            event = json.loads(row.payload) if row.payload else None
+                        except ValueError:
+                            event = None
+                        if not isinstance(event, dict):
+                            skipped += 1
+                            continue
+                        ruleset = device_rules.get(row.device_id, new)
+                        groups.setdefault(ruleset.version, (ruleset, []))[1].append((row, event))
+                    changes, gone = [], []
+                    for ruleset, members in groups.values():
+                        scored, bad = _score_members(members, ruleset)
+                        skipped += bad
+                        for (row, _), score, severity in scored:
+                            if severity == SEVERITY_LEVELS[0] and row.acked_at is not None:
+                                # an operator already handled it; keep the record as it was
+                                kept += 1
+                            elif severity == SEVERITY_LEVELS[0]:
+                                gone.append(row.id)
+                            elif (score, severity, ruleset.version) != (row.score, row.severity,
+                                                                        row.ruleset_version):
+                                changes.append({"b_id": row.id, "b_score": score, "b_severity": severity,
+                                                "b_version": ruleset.version})
+                    if changes:
+                        session.execute(stmt, changes)
+                    for start in range(0, len(gone), IN_CLAUSE_CHUNK):
+                        session.execute(delete(table).where(table.c.id.in_(gone[start:start + IN_CLAUSE_CHUNK])))
+                    session.commit()
+                    updated += len(changes)
+                    deleted += len(gone)
+    finally:
+        # committed chunks already changed Incident, so the rollups must follow even after an error
+        rollups.rebuild()
+    return updated, deleted, kept, skipped
+
+
+def _parse_date(raw: Optional[str]) -> Optional[datetime]:
+    return datetime.combine(date.fromisoformat(raw), datetime.min.time()) if raw else None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Diff incident severities between two rulesets over event history.")
+    parser.add_argument("--old", default=str(RULES_FILE), help="current rules file (default: the active one)")
+    parser.add_argument("--new", required=True, help="candidate rules file")
+    parser.add_argument("--jsonl", nargs="+", help="read these JSONL dumps instead of the database")
+    parser.add_argument("--from", dest="from_day", help="first day (YYYY-MM-DD), database source only")
+    parser.add_argument("--to", dest="to_day", help="last day (YYYY-MM-DD, inclusive), database source only")
+    parser.add_argument("--device", action="append", help="only these devices (repeatable), database source only")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk", type=int, default=CHUNK_ROWS, help="events per worker task")
+    parser.add_argument("--changes-only", action="store_true", help="only list (device, day) rows with changes")
+    parser.add_argument("--no-overrides", action="store_true", help="ignore device rule overrides")
+    parser.add_argument("--out", help="write the diff to this .csv or .json file (default: CSV on stdout)")
+    parser.add_argument("--rewrite", action="store_true", help="rescore stored incidents with the new rules")
+    args = parser.parse_args(argv)
+
+    from db import init_db
+
+    def load(path: str) -> RuleSet:
+        try:
+            return RuleSet(json.loads(Path(path).read_text()))
+        except (OSError, ValueError) as exc:
+            parser.error(f"cannot load rules from {path}: {exc}")
+
+    old, new = load(args.old), load(args.new)
+    init_db()
+    overrides = {} if args.no_overrides else _load_overrides()
+    if args.jsonl:
+        chunks = _jsonl_chunks(args.jsonl, args.chunk)
+    else:
+        to_ts = _parse_date(args.to_day)
+        if to_ts is not None:
+            to_ts = to_ts.replace(hour=23, minute=59, second=59, microsecond=999999)
+        chunks = _db_chunks(_parse_date(args.from_day), to_ts, args.device, args.chunk)
+
+    started = time.monotonic()
+    total, read, bad = run(chunks, old, new, overrides, max(1, args.workers))
+    elapsed = time.monotonic() - started
+    rows = diff_rows(total, args.changes_only)
+    write_rows(rows, args.out)
+    escalated = sum(r["escalated"] for r in rows)
+    downgraded = sum(r["downgraded"] for r in rows)
+    delta = sum(r["incident_delta"] for r in rows)
+    print(f"{read} events ({bad} unreadable) in {elapsed:.1f}s; {old.version} -> {new.version}: "
+          f"{escalated} escalated, {downgraded} downgraded, incident delta {delta:+d}", file=sys.stderr)
+
+    if args.rewrite:
+        updated, deleted, kept, skipped = rewrite_incidents(new, overrides)
+        print(f"rewrote {updated} incidents, deleted {deleted}, kept {kept} acknowledged, "
+              f"skipped {skipped} unscorable; rebuilt rollups", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""Load test for the Back API.
+
+Starts uvicorn on a free port with a throwaway database and storage dir,
+replays synthetic fleet traffic against it (one scenario at a time, each for
+`--duration` seconds with `--concurrency` clients), and reports throughput
+and p50/p95/p99 latency per endpoint. Results are written as JSON so runs on
+different commits can be compared:
+
+    python bench.py --duration 10 --concurrency 32 --out bench.json
+    python bench.py --url http://127.0.0.1:8000 --scenarios list_incidents
+
+Admission limits are lifted for the spawned server unless
+`--keep-admission` is given. Needs httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+HERE = Path(__file__).parent
+SCENARIOS = ("post_event", "post_events_batch", "upload_snapshot", "list_incidents", "stats")
+# a rough box around greater Tunis, where synthetic trips happen
+AREA = (36.70, 10.00, 36.95, 10.35)
+
+
+class Fleet:
+    """Synthetic devices producing plausible event payloads."""
+
+    def __init__(self, devices: int, seed: int):
+        self.rng = random.Random(seed)
+        self.devices = [f"bench-{i:05d}" for i in range(devices)]
+        self.position = {d: (self.rng.uniform(AREA[0], AREA[2]), self.rng.uniform(AREA[1], AREA[3]))
+                         for d in self.devices}
+        self.start = datetime.utcnow() - timedelta(hours=1)
+        self.ticks = 0
+
+    def event(self, device_id: Optional[str] = None) -> Dict:
+        rng = self.rng
+        device_id = device_id or rng.choice(self.devices)
+        lat, lon = self.position[device_id]
+        lat, lon = lat + rng.gauss(0, 0.001), lon + rng.gauss(0, 0.001)
+        self.position[device_id] = (lat, lon)
+        self.ticks += 1
+        drowsy = rng.random() < 0.1
+        return {
+            "device_id": device_id,
+            "event_id": uuid.uuid4().hex,
+            "timestamp": (self.start + timedelta(milliseconds=self.ticks * 50)).isoformat() + "Z",
+            "driver_state": {"eye_closed": rng.uniform(0.6, 1.0) if drowsy else rng.uniform(0, 0.2),
+                             "distracted": rng.uniform(0.5, 1.0) if rng.random() < 0.15 else rng.uniform(0, 0.2)},
+            "vehicle_model_score": rng.uniform(0, 0.6),
+            "telemetry": {"speed": max(0.0, rng.gauss(70, 25)), "heading": rng.uniform(0, 360)},
+            "location": {"lat": lat, "lon": lon},
+        }
+
+    def thumbnail(self) -> bytes:
+        # a third of the uploads repeat earlier content, like parked vehicles do
+        seed = self.rng.randrange(1000) if self.rng.random() < 0.33 else self.rng.getrandbits(64)
+        rng = random.Random(seed)
+        return b"\xff\xd8\xff\xe0" + rng.randbytes(rng.randint(8 * 1024, 32 * 1024)) + b"\xff\xd9"
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: List[float], statuses: Counter, elapsed: float, items: int) -> Dict:
+    lat = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None  # noqa: E731
+    return {
+        "requests": len(lat),
+        "errors": sum(n for status, n in statuses.items() if not (200 <= status < 300)),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(len(lat) / elapsed, 1) if elapsed else None,
+        "events_per_s": round(items / elapsed, 1) if elapsed and items else None,
+        "p50_ms": ms(percentile(lat, 50)),
+        "p95_ms": ms(percentile(lat, 95)),
+        "p99_ms": ms(percentile(lat, 99)),
+        "max_ms": ms(lat[-1] if lat else None),
+    }
+
+
+def make_requests(fleet: Fleet, batch_size: int) -> Dict[str, Callable]:
+    """Per scenario, a function returning (method, path, request kwargs, items sent)."""
+
+    def post_event():
+        return "POST", "/api/v1/events", {"json": fleet.event()}, 1
+
+    def post_events_batch():
+        device_id = fleet.rng.choice(fleet.devices)
+        body = [fleet.event(device_id) for _ in range(batch_size)]
+        return "POST", "/api/v1/events/batch", {"json": body}, batch_size
+
+    def upload_snapshot():
+        data = {"device_id": fleet.rng.choice(fleet.devices), "timestamp": datetime.utcnow().isoformat()}
+        return "POST", "/api/v1/snapshots", {"data": data, "files": {"file": ("thumb.jpg", fleet.thumbnail(),
+                                                                                 "image/jpeg")}}, 1
+
+    def list_incidents():
+        params = {"limit": 100}
+        roll = fleet.rng.random()
+        if roll < 0.4:
+            params["device_id"] = fleet.rng.choice(fleet.devices)
+        elif roll < 0.6:
+            params["severity"] = "high"
+        elif roll < 0.8:
+            lat, lon = fleet.rng.uniform(AREA[0], AREA[2]), fleet.rng.uniform(AREA[1], AREA[3])
+            params["bbox"] = f"{lon - 0.05},{lat - 0.05},{lon + 0.05},{lat + 0.05}"
+        return "GET", "/api/v1/incidents", {"params": params}, 0
+
+    def stats():
+        params = {"granularity": fleet.rng.choice(["minute", "hour"]), "group_by": "bucket,severity"}
+        if fleet.rng.random() < 0.5:
+            params["device_id"] = fleet.rng.choice(fleet.devices)
+        return "GET", "/api/v1/stats", {"params": params}, 0
+
+    return {name: fn for name, fn in locals().items() if name in SCENARIOS}
+
+
+async def run_scenario(client, make: Callable, duration: float, concurrency: int) -> Dict:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    items = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal items
+        while time.perf_counter() < deadline:
+            method, path, kwargs, n = make()
+            started = time.perf_counter()
+            try:
+                resp = await client.request(method, path, **kwargs)
+                await resp.aread()
+                status = resp.status_code
+            except Exception:
+                status = 0
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+            if 200 <= status < 300:
+                items += n
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - started, items)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir: Path, port: int, args) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "SAFENET_DB_URL": f"sqlite:///{workdir / 'bench.db'}",
+        "SAFENET_STORAGE_DIR": str(workdir),
+        "SAFENET_MAINTENANCE_INTERVAL": "0",
+        "SAFENET_SHARDS": str(args.shards),
+    })
+    if not args.keep_admission:
+        env.update({"SAFENET_DEVICE_RATE": "1e9", "SAFENET_DEVICE_BURST": "1e9", "SAFENET_MAX_INFLIGHT": "100000"})
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning", "--workers", str(args.workers)]
+    return subprocess.Popen(cmd, cwd=HERE, env=env)
+
+
+async def wait_ready(client, server: Optional[subprocess.Popen], timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}")
+        try:
+            if (await client.get("/api/v1/rules")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not become ready")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench(args, base_url: str, server: Optional[subprocess.Popen]) -> Dict:
+    import httpx
+
+    fleet = Fleet(args.devices, args.seed)
+    makers = make_requests(fleet, args.batch_size)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        await wait_ready(client, server)
+        for name in args.scenarios:
+            result = await run_scenario(client, makers[name], args.duration, args.concurrency)
+            results[name] = result
+            print(f"{name:<18} {result['requests_per_s'] or 0:>9.1f} req/s  "
+                  f"p50 {result['p50_ms'] or 0:>8.2f} ms  p95 {result['p95_ms'] or 0:>8.2f} ms  "
+                  f"p99 {result['p99_ms'] or 0:>8.2f} ms  errors {result['errors']}", flush=True)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Back API with synthetic fleet traffic.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated, run in this order (default: {','.join(SCENARIOS)})")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--devices", type=int, default=200, help="simulated devices")
+    parser.add_argument("--batch-size", type=int, default=50, help="events per batch request")
+    parser.add_argument("--shards", type=int, default=1, help="SAFENET_SHARDS for the spawned server")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the spawned server")
+    parser.add_argument("--keep-admission", action="store_true", help="keep the default admission limits")
+    parser.add_argument("--url", help="benchmark a running server instead of spawning one")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="bench-results.json", help="JSON output path")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        parser.error("bench.py needs httpx (pip install httpx)")
+
+    started_at = datetime.utcnow().isoformat() + "Z"
+    with tempfile.TemporaryDirectory(prefix="safenet-bench-") as tmp:
+        server = None
+        base_url = args.url
+        if base_url is None:
+            port = free_port()
+            server = start_server(Path(tmp), port, args)
+            base_url = f"http://127.0.0.1:{port}"
+        try:
+            results = asyncio.run(bench(args, base_url, server))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=30)
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "url": args.url,
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "url")},
+        },
+        "results": results,
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    print(f"wrote {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
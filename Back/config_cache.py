@@ -0,0 +1,117 @@
+"""In-memory cache of device configs with versions and change notification.
+
+Reads are served from memory after the first load of a device. Lookups of
+unknown devices are cached too, but only for `miss_ttl` seconds and at most
+`max_misses` of them (least recently used first out), so probing random ids
+cannot grow the cache without bound. Writes go through `update`, which
+replaces the entry with the new version and wakes long-pollers waiting on
+that device.
+Config versions only grow, so an entry is never replaced by a lower version:
+writes and reloads that finish out of order cannot bring back a stale config.
+Entries are also refreshed after `ttl` seconds, so writes made by another
+API process show up eventually; long-polls are only woken by writes made in
+this process.
+"""
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+
+class CachedConfig(NamedTuple):
+    config: Optional[dict]
+    version: int
+    loaded_at: float
+
+    @property
+    def etag(self) -> str:
+        return f'"v{self.version}"'
+
+
+Loader = Callable[[str], Awaitable[Optional[tuple]]]
+
+
+class DeviceConfigCache:
+    def __init__(self, loader: Loader, ttl: float = 60.0, miss_ttl: float = 5.0, max_misses: int = 10_000):
+        """`loader(device_id)` returns (config_json, version) from the database, or None."""
+        self._loader = loader
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_misses = max_misses
+        self._entries: Dict[str, CachedConfig] = {}
+        self._missing: "OrderedDict[str, CachedConfig]" = OrderedDict()
+        self._changed: Dict[str, asyncio.Event] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, device_id: str) -> CachedConfig:
+        entry = self._entries.get(device_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl:
+            self.hits += 1
+            return entry
+        missing = self._missing.get(device_id)
+        if missing is not None and time.monotonic() - missing.loaded_at < self.miss_ttl:
+            self._missing.move_to_end(device_id)
+            self.hits += 1
+            return missing
+        self.misses += 1
+        row = await self._loader(device_id)
+        if row is None:
+            if device_id in self._entries:
+                # an update() landed while the row was being read
+                return self._entries[device_id]
+            entry = CachedConfig(None, 0, time.monotonic())
+            self._missing[device_id] = entry
+            self._missing.move_to_end(device_id)
+            while len(self._missing) > self.max_misses:
+                self._missing.popitem(last=False)
+            return entry
+        raw, version = row
+        entry = CachedConfig(json.loads(raw) if raw else None, version or 0, time.monotonic())
+        self._missing.pop(device_id, None)
+        previous = self._entries.get(device_id)
+        if previous is not None and previous.version > entry.version:
+            # an update() landed while the row was being read; the read is older
+            return previous
+        self._entries[device_id] = entry
+        if previous is not None and previous.version != entry.version:
+            self._notify(device_id)
+        return entry
+
+    def update(self, device_id: str, config: dict, version: int) -> CachedConfig:
+        previous = self._entries.get(device_id)
+        if previous is not None and previous.version > version:
+            # a later write already finished first
+            return previous
+        entry = CachedConfig(config, version, time.monotonic())
+        self._entries[device_id] = entry
+        self._missing.pop(device_id, None)
+        self._notify(device_id)
+        return entry
+
+    def _notify(self, device_id: str) -> None:
+        event = self._changed.pop(device_id, None)
+        if event is not None:
+            event.set()
+
+    async def wait_for_change(self, device_id: str, known_version: int, timeout: float) -> Optional[CachedConfig]:
+        """Return the entry once its version differs from `known_version`, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            entry = await self.get(device_id)
+            if entry.version != known_version:
+                return entry
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            event = self._changed.setdefault(device_id, asyncio.Event())
+            try:
+                # wake at least every ttl to pick up writes from other processes
+                await asyncio.wait_for(event.wait(), min(remaining, self.ttl))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "missing_entries": len(self._missing), "hits": self.hits,
+                "misses": self.misses, "waiting_devices": len(self._changed)}
@@ -0,0 +1,191 @@
+"""Database engine and executors for the async request path.
+
+SQLModel/SQLite calls are blocking, so request handlers never run them on the
+event loop. Writes go through a single-thread executor (SQLite allows one
+writer at a time, serialising them here avoids lock contention and busy
+retries); reads use a small pool that runs concurrently thanks to WAL mode.
+
+With SAFENET_SHARDS=N (N > 1), Event, Incident and IncidentRollup rows are
+partitioned by device across N extra database files, each with its own
+writer thread, so ingestion is no longer capped by one SQLite writer. The
+main database keeps every other table. N must not change once data exists:
+`shard_for` and the global incident ids both depend on it.
+"""
+import asyncio
+import functools
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlmodel import SQLModel, create_engine
+
+DB_FILE = os.environ.get("SAFENET_DB_URL", "sqlite:///./fastapi_prototype.db")
+READ_WORKERS = int(os.environ.get("SAFENET_DB_READ_WORKERS", "4"))
+SHARD_COUNT = max(1, int(os.environ.get("SAFENET_SHARDS", "1")))
+# FULL fsyncs the WAL on every commit, which is what makes a "sync" ingest ack
+# survive power loss; group commits keep that to one fsync per batch. NORMAL
+# only survives process crashes (the last commits can be lost on power loss).
+SQLITE_SYNCHRONOUS = os.environ.get("SAFENET_SQLITE_SYNCHRONOUS", "FULL").upper()
+if SQLITE_SYNCHRONOUS not in ("FULL", "NORMAL"):
+    raise ValueError("SAFENET_SQLITE_SYNCHRONOUS must be FULL or NORMAL")
+# values per IN (...) list; (device_id, event_id) pairs bind two parameters
+# each, so this stays below SQLite's default limit of 999
+IN_CLAUSE_CHUNK = 400
+# tables partitioned by device_id; everything else lives in the main database
+SHARDED_TABLES = ("event", "incident", "incidentrollup")
+
+T = TypeVar("T")
+
+
+def make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=False, pool_pre_ping=True)
+    # one pooled connection per executor thread, shared across threads
+    engine = create_engine(
+        url,
+        echo=False,
+        connect_args={"check_same_thread": False, "timeout": 30},
+        poolclass=QueuePool,
+        pool_size=READ_WORKERS + 1,
+        max_overflow=READ_WORKERS,
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def _set_sqlite_pragmas(dbapi_conn, _record) -> None:
+    cur = dbapi_conn.cursor()
+    # WAL lets readers proceed while the writer commits
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-16000")
+    cur.close()
+
+
+def shard_url(shard: int) -> str:
+    """URL of shard `shard`: SAFENET_SHARD_URL (with a {shard} field) or DB_FILE with a suffix."""
+    template = os.environ.get("SAFENET_SHARD_URL")
+    if template:
+        return template.format(shard=shard)
+    base, dot, ext = DB_FILE.rpartition(".")
+    return f"{base}.shard{shard}.{ext}" if dot and "/" not in ext else f"{DB_FILE}.shard{shard}"
+
+
+engine = make_engine(DB_FILE)
+# a single shard is the main database itself, so N=1 keeps the original layout
+shard_engines = [engine] if SHARD_COUNT == 1 else [make_engine(shard_url(i)) for i in range(SHARD_COUNT)]
+
+
+def shard_for(device_id: str) -> int:
+    # crc32 rather than hash(): it must agree across processes and restarts
+    return zlib.crc32(device_id.encode("utf-8")) % SHARD_COUNT
+
+
+def to_global_id(shard: int, local_id: int) -> int:
+    """Incident id exposed by the API; identical to the row id when there is one shard."""
+    return local_id * SHARD_COUNT + shard
+
+
+def split_global_id(global_id: int) -> Tuple[int, int]:
+    """(shard, row id) of a global incident id."""
+    return global_id % SHARD_COUNT, global_id // SHARD_COUNT
+
+
+def init_db(bind=None) -> None:
+    """Create missing tables, then columns and indexes added to tables that already exist."""
+    import models  # noqa: F401  (registers the tables on SQLModel.metadata)
+
+    tables = SQLModel.metadata.sorted_tables
+    if bind is not None or SHARD_COUNT == 1:
+        _init_tables(bind or engine, tables)
+        return
+    _init_tables(engine, [t for t in tables if t.name not in SHARDED_TABLES])
+    for shard_engine in shard_engines:
+        _init_tables(shard_engine, [t for t in tables if t.name in SHARDED_TABLES])
+
+
+def _init_tables(bind, tables: List, attempts: int = 3) -> None:
+    for attempt in range(attempts):
+        try:
+            SQLModel.metadata.create_all(bind, tables=tables)
+            _add_missing_columns(bind, tables)
+            for table in tables:
+                for index in table.indexes:
+                    index.create(bind, checkfirst=True)
+            return
+        except OperationalError:
+            # several uvicorn workers start at once; whoever lost the race to
+            # create something sees it on the next pass
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.2)
+
+
+def dispose_all() -> None:
+    for shard_engine in shard_engines:
+        if shard_engine is not engine:
+            shard_engine.dispose()
+    engine.dispose()
+
+
+def _add_missing_columns(bind, tables: List) -> None:
+    # prototype-grade migration: new model fields are nullable, so ADD COLUMN is enough
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    col_type = column.type.compile(dialect=bind.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}')
+
+
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+_read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="db-read")
+_shard_write_executors = [_write_executor] if SHARD_COUNT == 1 else [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-write-shard{i}") for i in range(SHARD_COUNT)
+]
+
+
+def executor_backlog() -> Dict[str, int]:
+    """Tasks waiting (not yet running) on each DB executor."""
+    backlog = {"read": _read_executor._work_queue.qsize(), "write": _write_executor._work_queue.qsize()}
+    if SHARD_COUNT > 1:
+        for i, executor in enumerate(_shard_write_executors):
+            backlog[f"write_shard{i}"] = executor._work_queue.qsize()
+    return backlog
+
+
+async def run_read(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking read `fn(*args, **kwargs)` on the reader pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_write(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking write `fn(*args, **kwargs)` on the single writer thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_write_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_shard_write(shard: int, fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking write on the writer thread of `shard` (the main writer when N=1)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_shard_write_executors[shard], functools.partial(fn, *args, **kwargs))
+
+
+async def gather_shards(fn: Callable[..., T], *args, shards=None, **kwargs) -> List[T]:
+    """Run the blocking read `fn(shard, *args, **kwargs)` on every shard concurrently.
+
+    `shards` restricts the scatter to the given shard numbers; results come
+    back in that order.
+    """
+    shards = range(SHARD_COUNT) if shards is None else shards
+    return list(await asyncio.gather(*(run_read(fn, i, *args, **kwargs) for i in shards)))
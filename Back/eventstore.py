@@ -0,0 +1,243 @@
+"""Time-partitioned event store.
+
+Raw events go to one table per day of their timestamp (``event_YYYYMMDD``)
+instead of a single ever-growing table. The fields we filter or aggregate on
+(device, time, the scored features, score and severity) are typed columns;
+the full request is kept as zlib-compressed JSON for the rare reads that
+need it. Time-range scans only open the partitions of the days they cover,
+and retention drops whole partitions, which is a metadata operation rather
+than a row-by-row DELETE.
+
+Partitions live on the storage shard of their devices (see `db.shard_for`).
+(device_id, event_id) is unique within a partition; retries carry the
+event's own timestamp, so they land in the partition of the original.
+
+    python eventstore.py migrate     # move rows from the legacy Event table
+    python eventstore.py retention   # drop partitions past SAFENET_EVENT_RETENTION_DAYS
+"""
+import json
+import os
+import re
+import sys
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from sqlalchemy import (Column, DateTime, Float, Index, Integer, LargeBinary, MetaData, String, Table, and_,
+                        delete, event, inspect, select, tuple_)
+from sqlmodel import Session
+
+from db import IN_CLAUSE_CHUNK, shard_engines
+from rules import extract_features
+
+PARTITION_PREFIX = "event_"
+PARTITION_RE = re.compile(r"^event_(\d{8})$")
+# 0 keeps raw events forever; incidents and rollups are never dropped by this
+RETENTION_DAYS = float(os.environ.get("SAFENET_EVENT_RETENTION_DAYS", "0"))
+COMPRESS_LEVEL = 6
+SCAN_CHUNK = 1000
+
+# partition tables are created on demand, so they stay out of SQLModel.metadata
+_metadata = MetaData()
+_tables: Dict[str, Table] = {}
+# partition names known to exist, per engine
+_existing: Dict[object, Set[str]] = {}
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def partition_day(name: str) -> Optional[date]:
+    m = PARTITION_RE.match(name)
+    return datetime.strptime(m.group(1), "%Y%m%d").date() if m else None
+
+
+def partition_table(name: str) -> Table:
+    table = _tables.get(name)
+    if table is None:
+        table = Table(
+            name, _metadata,
+            Column("id", Integer, primary_key=True),
+            Column("event_id", String, nullable=False),
+            Column("device_id", String, nullable=False),
+            Column("timestamp", DateTime, nullable=False),
+            Column("eye_closed", Float),
+            Column("distracted", Float),
+            Column("vehicle_model_score", Float),
+            Column("speed", Float),
+            Column("score", Float),
+            Column("severity", String),
+            Column("ruleset_version", String),
+            Column("payload", LargeBinary),
+            Index(f"ux_{name}_device_event", "device_id", "event_id", unique=True),
+            Index(f"ix_{name}_device_ts", "device_id", "timestamp"),
+        )
+        _tables[name] = table
+    return table
+
+
+def encode_payload(event: Dict) -> bytes:
+    return zlib.compress(json.dumps(event, separators=(",", ":")).encode("utf-8"), COMPRESS_LEVEL)
+
+
+def decode_payload(blob: Optional[bytes]) -> Optional[Dict]:
+    return json.loads(zlib.decompress(blob)) if blob is not None else None
+
+
+def partitions(bind) -> List[str]:
+    """Names of the existing partitions on `bind`, oldest first."""
+    names = sorted(n for n in inspect(bind).get_table_names() if PARTITION_RE.match(n))
+    _existing[bind] = set(names)
+    return names
+
+
+def ensure_partition(session: Session, day: date) -> Table:
+    """The partition table for `day`, created in the session's transaction if needed."""
+    name = partition_name(day)
+    table = partition_table(name)
+    bind = session.get_bind()
+    known = _existing.setdefault(bind, set())
+    if name not in known:
+        # checkfirst: another API process may have created it meanwhile
+        table.create(session.connection(), checkfirst=True)
+        # the CREATE is part of the session's transaction: only remember it once committed
+        session.info.setdefault("eventstore_created", set()).add((bind, name))
+    return table
+
+
+@event.listens_for(Session, "after_commit")
+def _partitions_committed(session) -> None:
+    for bind, name in session.info.pop("eventstore_created", ()):
+        _existing.setdefault(bind, set()).add(name)
+
+
+@event.listens_for(Session, "after_rollback")
+def _partitions_rolled_back(session) -> None:
+    session.info.pop("eventstore_created", None)
+
+
+def insert_rows(session: Session, table: Table, rows: List[Dict]) -> None:
+    """Insert `rows` (dicts with `event` plus the typed column values) in one executemany."""
+    eye, dis, vms, speed = (col.tolist() for col in extract_features(row["event"] for row in rows))
+    values = []
+    for row, e, d, v, s in zip(rows, eye, dis, vms, speed):
+        values.append({
+            "event_id": row["event_id"], "device_id": row["device_id"], "timestamp": row["timestamp"],
+            "eye_closed": e, "distracted": d, "vehicle_model_score": v, "speed": s,
+            "score": row.get("score"), "severity": row.get("severity"),
+            "ruleset_version": row.get("ruleset_version"), "payload": encode_payload(row["event"]),
+        })
+    session.execute(table.insert(), values)
+
+
+def stored_keys(session: Session, table: Table, keys: List[tuple], chunk: int = IN_CLAUSE_CHUNK) -> Set[tuple]:
+    """Which (device_id, event_id) `keys` are already in partition `table`."""
+    found = set()
+    for start in range(0, len(keys), chunk):
+        q = select(table.c.device_id, table.c.event_id).where(
+            tuple_(table.c.device_id, table.c.event_id).in_(keys[start:start + chunk]))
+        found.update(tuple(row) for row in session.execute(q))
+    return found
+
+
+def partitions_between(bind, from_ts: Optional[datetime], to_ts: Optional[datetime]) -> List[str]:
+    first = from_ts.date() if from_ts is not None else None
+    last = to_ts.date() if to_ts is not None else None
+    return [
+        name for name in partitions(bind)
+        if (first is None or partition_day(name) >= first) and (last is None or partition_day(name) <= last)
+    ]
+
+
+def iter_events(bind, from_ts: Optional[datetime] = None, to_ts: Optional[datetime] = None,
+                device_ids: Optional[Iterable[str]] = None, with_payload: bool = True,
+                chunk_size: int = SCAN_CHUNK) -> Iterator[Dict]:
+    """Stream events of one shard in time order, reading only the partitions in range.
+
+    Yields dicts of the typed columns, plus the decoded `event` when
+    `with_payload` is set.
+    """
+    from_ts = from_ts.replace(tzinfo=None) if from_ts is not None else None
+    to_ts = to_ts.replace(tzinfo=None) if to_ts is not None else None
+    device_ids = list(device_ids) if device_ids else None
+    for name in partitions_between(bind, from_ts, to_ts):
+        table = partition_table(name)
+        cols = [c for c in table.c if with_payload or c.name != "payload"]
+        q = select(*cols)
+        if from_ts is not None:
+            q = q.where(table.c.timestamp >= from_ts)
+        if to_ts is not None:
+            q = q.where(table.c.timestamp <= to_ts)
+        if device_ids:
+            q = q.where(table.c.device_id.in_(device_ids))
+        q = q.order_by(table.c.timestamp, table.c.id)
+        with bind.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(q)
+            for row in result.mappings():
+                out = dict(row)
+                if with_payload:
+                    out["event"] = decode_payload(out.pop("payload"))
+                yield out
+
+
+def drop_partitions_before(bind, cutoff: date) -> List[str]:
+    """Drop every partition of a day before `cutoff`; returns the dropped names."""
+    dropped = []
+    for name in partitions(bind):
+        if partition_day(name) >= cutoff:
+            break
+        partition_table(name).drop(bind, checkfirst=True)
+        _existing.get(bind, set()).discard(name)
+        dropped.append(name)
+    return dropped
+
+
+def expire_partitions(bind, retention_days: float = RETENTION_DAYS) -> List[str]:
+    if retention_days <= 0:
+        return []
+    return drop_partitions_before(bind, (datetime.utcnow() - timedelta(days=retention_days)).date())
+
+
+def migrate_legacy(bind, chunk_size: int = 5000) -> int:
+    """Move rows of the legacy Event table into partitions; returns the number moved."""
+    from models import Event
+
+    moved = 0
+    while True:
+        with Session(bind) as session:
+            rows = session.execute(select(Event).order_by(Event.id).limit(chunk_size)).scalars().all()
+            if not rows:
+                return moved
+            by_day: Dict[date, List[Dict]] = {}
+            for ev in rows:
+                try:
+                    event = json.loads(ev.payload) if ev.payload else {}
+                except ValueError:
+                    event = {"raw": ev.payload}
+                by_day.setdefault(ev.timestamp.date(), []).append(
+                    {"event_id": ev.event_id, "device_id": ev.device_id, "timestamp": ev.timestamp, "event": event})
+            for day, day_rows in by_day.items():
+                table = ensure_partition(session, day)
+                seen = stored_keys(session, table, [(r["device_id"], r["event_id"]) for r in day_rows])
+                fresh = [r for r in day_rows if (r["device_id"], r["event_id"]) not in seen]
+                if fresh:
+                    insert_rows(session, table, fresh)
+            session.execute(delete(Event).where(and_(Event.id >= rows[0].id, Event.id <= rows[-1].id)))
+            session.commit()
+            moved += len(rows)
+
+
+if __name__ == "__main__":
+    from db import init_db
+
+    init_db()
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "migrate":
+        print(f"moved {sum(migrate_legacy(e) for e in shard_engines)} legacy events into partitions")
+    elif command == "retention":
+        dropped = [name for e in shard_engines for name in expire_partitions(e)]
+        print(f"dropped {len(dropped)} partitions")
+    else:
+        print(__doc__)
+        sys.exit(2)
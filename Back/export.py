@@ -0,0 +1,215 @@
+"""Bulk export of incidents and events as CSV, NDJSON or Parquet.
+
+Rows are read through a streaming cursor per shard (merged by timestamp) and
+encoded chunk by chunk, so memory stays flat however many rows are exported.
+`iter_export` is a plain generator of encoded byte chunks; the API drives it
+on the DB reader pool one chunk at a time. A running export keeps a pooled
+connection and a read snapshot open per shard until it ends, so the API
+runs at most MAX_CONCURRENT of them (see `ExportSlots`). Parquet needs
+pyarrow, which is optional: without it `check_format("parquet")` raises
+ImportError.
+"""
+import csv
+import heapq
+import io
+import json
+import os
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import select
+
+import eventstore
+from db import SHARD_COUNT, shard_engines, shard_for, to_global_id
+from models import Incident
+
+KINDS = ("incidents", "events")
+FORMATS = ("csv", "ndjson", "parquet")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+EXPORT_CHUNK = 5000
+MAX_CONCURRENT = int(os.environ.get("SAFENET_MAX_EXPORTS", "2"))
+
+COLUMNS = {
+    "incidents": [("id", "int"), ("device_id", "str"), ("timestamp", "ts"), ("score", "float"),
+                  ("severity", "str"), ("ruleset_version", "str"), ("event_id", "str"), ("thumbnail_path", "str"),
+                  ("lat", "float"), ("lon", "float"), ("acked_at", "ts"), ("acked_by", "str")],
+    "events": [("event_id", "str"), ("device_id", "str"), ("timestamp", "ts"), ("eye_closed", "float"),
+               ("distracted", "float"), ("vehicle_model_score", "float"), ("speed", "float"), ("score", "float"),
+               ("severity", "str"), ("ruleset_version", "str")],
+}
+
+
+class ExportSlots:
+    """Counter of running exports, capped at `limit`."""
+
+    def __init__(self, limit: int = MAX_CONCURRENT):
+        self.limit = limit
+        self.running = 0
+        self.rejected = 0
+
+    def acquire(self) -> Optional[Callable[[], None]]:
+        """Take a slot; returns its release function (safe to call twice), or None when all are taken."""
+        if self.running >= self.limit:
+            self.rejected += 1
+            return None
+        self.running += 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.running -= 1
+        return release
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": self.running, "limit": self.limit, "rejected": self.rejected}
+
+
+def check_format(fmt: str) -> None:
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt == "parquet":
+        import pyarrow.parquet  # noqa: F401
+
+
+def columns(kind: str, payload: bool) -> List[str]:
+    names = [name for name, _ in COLUMNS[kind]]
+    return names + ["payload"] if payload and kind == "events" else names
+
+
+def _incident_rows(shard: int, from_ts, to_ts, device_id, severity) -> Iterator[Dict]:
+    table = Incident.__table__
+    q = select(table.c.id, table.c.device_id, table.c.timestamp, table.c.score, table.c.severity,
+               table.c.ruleset_version, table.c.event_id, table.c.thumbnail_path, table.c.lat, table.c.lon,
+               table.c.acked_at, table.c.acked_by)
+    if from_ts is not None:
+        q = q.where(table.c.timestamp >= from_ts)
+    if to_ts is not None:
+        q = q.where(table.c.timestamp <= to_ts)
+    if device_id:
+        q = q.where(table.c.device_id == device_id)
+    if severity:
+        q = q.where(table.c.severity == severity)
+    q = q.order_by(table.c.timestamp, table.c.id)
+    with shard_engines[shard].connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK).execute(q)
+        for row in result.mappings():
+            out = dict(row)
+            out["id"] = to_global_id(shard, out["id"])
+            yield out
+
+
+def _event_rows(shard: int, from_ts, to_ts, device_id, severity, payload: bool) -> Iterator[Dict]:
+    rows = eventstore.iter_events(shard_engines[shard], from_ts, to_ts, [device_id] if device_id else None,
+                                  with_payload=payload, chunk_size=EXPORT_CHUNK)
+    for row in rows:
+        if severity and row["severity"] != severity:
+            continue
+        if payload:
+            row["payload"] = json.dumps(row.pop("event"))
+        yield row
+
+
+def iter_rows(kind: str, from_ts: Optional[datetime] = None, to_ts: Optional[datetime] = None,
+              device_id: Optional[str] = None, severity: Optional[str] = None, payload: bool = False) -> Iterator[Dict]:
+    """Rows of `kind` in timestamp order across every shard (only the device's with `device_id`)."""
+    from_ts = from_ts.replace(tzinfo=None) if from_ts is not None else None
+    to_ts = to_ts.replace(tzinfo=None) if to_ts is not None else None
+    shards = [shard_for(device_id)] if device_id else range(SHARD_COUNT)
+    if kind == "incidents":
+        parts = [_incident_rows(shard, from_ts, to_ts, device_id, severity) for shard in shards]
+    else:
+        parts = [_event_rows(shard, from_ts, to_ts, device_id, severity, payload) for shard in shards]
+    if len(parts) == 1:
+        return parts[0]
+    return heapq.merge(*parts, key=lambda row: row["timestamp"])
+
+
+def _chunks(rows: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"cannot serialise {type(value).__name__}")
+
+
+def _encode_ndjson(names: List[str], chunks: Iterator[List[Dict]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(json.dumps({n: row.get(n) for n in names}, default=_json_default) + "\n"
+                      for row in chunk).encode("utf-8")
+
+
+def _encode_csv(names: List[str], chunks: Iterator[List[Dict]]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(names)
+    for chunk in chunks:
+        for row in chunk:
+            writer.writerow([row[n].isoformat() if isinstance(row.get(n), datetime) else row.get(n) for n in names])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _Drain:
+    """Write-only file object whose contents are taken out after every row group."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _encode_parquet(kind: str, names: List[str], chunks: Iterator[List[Dict]]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"int": pa.int64(), "str": pa.string(), "float": pa.float64(), "ts": pa.timestamp("us")}
+    fields = dict(COLUMNS[kind], payload="str")
+    schema = pa.schema([(n, types[fields[n]]) for n in names])
+    drain = _Drain()
+    # one row group per chunk, handed out as soon as it is written
+    with pq.ParquetWriter(pa.PythonFile(drain, mode="w"), schema, compression="zstd") as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pydict({n: [row.get(n) for row in chunk] for n in names}, schema=schema))
+            yield drain.take()
+    yield drain.take()
+
+
+def iter_export(kind: str, fmt: str, from_ts: Optional[datetime] = None, to_ts: Optional[datetime] = None,
+                device_id: Optional[str] = None, severity: Optional[str] = None,
+                payload: bool = False) -> Iterator[bytes]:
+    """Encoded chunks of the export, EXPORT_CHUNK rows at a time."""
+    names = columns(kind, payload)
+    chunks = _chunks(iter_rows(kind, from_ts, to_ts, device_id, severity, payload), EXPORT_CHUNK)
+    if fmt == "csv":
+        return _encode_csv(names, chunks)
+    if fmt == "ndjson":
+        return _encode_ndjson(names, chunks)
+    return _encode_parquet(kind, names, chunks)
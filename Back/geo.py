@@ -0,0 +1,168 @@
+"""Grid index for incident locations.
+
+Incidents carry `lat`/`lon` from the event's ``location`` and a `geo_cell`:
+the index of the GRID_DEG x GRID_DEG cell containing the point, numbered row
+by row from (-90, -180). A bounding box covers a contiguous run of cells in
+each grid row, so it becomes a few BETWEENs on the indexed `geo_cell` column
+(plus the exact lat/lon test), and the heatmap groups by `geo_cell` without
+touching payloads.
+
+Backfill incidents stored before the columns existed with:
+
+    python geo.py backfill
+"""
+import json
+import math
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, update
+from sqlmodel import Session, select
+
+from db import shard_engines
+from models import Incident
+
+GRID_DEG = 0.1
+GRID_ROWS = int(round(180 / GRID_DEG))
+GRID_COLS = int(round(360 / GRID_DEG))
+# boxes spanning more grid rows only use the lat/lon range test
+MAX_CELL_RANGES = 64
+HEATMAP_MAX_CELLS = 10000
+
+
+class BBox(NamedTuple):
+    min_lon: float
+    min_lat: float
+    max_lon: float
+    max_lat: float
+
+
+def parse_bbox(raw: str) -> BBox:
+    """Parse "min_lon,min_lat,max_lon,max_lat" (GeoJSON order); raises ValueError."""
+    try:
+        box = BBox(*(float(v) for v in raw.split(",")))
+    except (TypeError, ValueError):
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not (-180 <= box.min_lon <= box.max_lon <= 180 and -90 <= box.min_lat <= box.max_lat <= 90):
+        raise ValueError("bbox must satisfy -180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90")
+    return box
+
+
+def location_of(event: Dict) -> Tuple[Optional[float], Optional[float]]:
+    """(lat, lon) from the event's `location`, or (None, None) when missing or invalid."""
+    loc = event.get("location")
+    if not isinstance(loc, dict):
+        return None, None
+    try:
+        lat, lon = float(loc["lat"]), float(loc["lon"])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None, None
+    # NaN fails every comparison below; infinities fall outside the ranges
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None, None
+    return lat, lon
+
+
+def _row(lat: float) -> int:
+    return min(int(math.floor((lat + 90) / GRID_DEG)), GRID_ROWS - 1)
+
+
+def _col(lon: float) -> int:
+    return min(int(math.floor((lon + 180) / GRID_DEG)), GRID_COLS - 1)
+
+
+def cell_of(lat: Optional[float], lon: Optional[float]) -> Optional[int]:
+    if lat is None or lon is None:
+        return None
+    return _row(lat) * GRID_COLS + _col(lon)
+
+
+def bbox_clause(box: BBox):
+    """WHERE clause selecting incidents inside `box`, driven by the geo_cell index."""
+    conds = [Incident.lat.between(box.min_lat, box.max_lat), Incident.lon.between(box.min_lon, box.max_lon)]
+    first_row, last_row = _row(box.min_lat), _row(box.max_lat)
+    if last_row - first_row < MAX_CELL_RANGES:
+        first_col, last_col = _col(box.min_lon), _col(box.max_lon)
+        conds.append(or_(*(
+            Incident.geo_cell.between(row * GRID_COLS + first_col, row * GRID_COLS + last_col)
+            for row in range(first_row, last_row + 1)
+        )))
+    return and_(*conds)
+
+
+def heatmap_cells(session: Session, box: Optional[BBox], from_ts, to_ts, severity: Optional[str]) -> List[tuple]:
+    """(geo_cell, count, score_sum, score_max) per grid cell with incidents, for one shard."""
+    q = select(Incident.geo_cell, func.count(), func.sum(Incident.score), func.max(Incident.score))
+    q = q.where(Incident.geo_cell.isnot(None))
+    if box is not None:
+        q = q.where(bbox_clause(box))
+    if from_ts is not None:
+        q = q.where(Incident.timestamp >= from_ts)
+    if to_ts is not None:
+        q = q.where(Incident.timestamp <= to_ts)
+    if severity:
+        q = q.where(Incident.severity == severity)
+    return session.exec(q.group_by(Incident.geo_cell)).all()
+
+
+def merge_heatmap(parts: List[List[tuple]], cell_deg: float) -> List[Dict]:
+    """Merge per-shard cells into `cell_deg`-sized cells (a multiple of GRID_DEG), busiest first."""
+    factor = max(1, int(round(cell_deg / GRID_DEG)))
+    size = factor * GRID_DEG
+    merged: Dict[Tuple[int, int], List[float]] = {}
+    for part in parts:
+        for cell, count, score_sum, score_max in part:
+            key = (cell // GRID_COLS // factor, cell % GRID_COLS // factor)
+            acc = merged.get(key)
+            if acc is None:
+                merged[key] = [count, score_sum, score_max]
+            else:
+                acc[0] += count
+                acc[1] += score_sum
+                acc[2] = max(acc[2], score_max)
+    cells = sorted(merged.items(), key=lambda item: -item[1][0])[:HEATMAP_MAX_CELLS]
+    return [
+        {"lat": round(row * size - 90 + size / 2, 6), "lon": round(col * size - 180 + size / 2, 6),
+         "cell_deg": round(size, 6), "count": acc[0], "avg_score": acc[1] / acc[0], "max_score": acc[2]}
+        for (row, col), acc in cells
+    ]
+
+
+def backfill(chunk_size: int = 5000) -> int:
+    """Fill lat/lon/geo_cell of incidents stored before they existed; returns rows updated."""
+    updated = 0
+    for engine in shard_engines:
+        last_id = 0
+        while True:
+            with Session(engine) as session:
+                rows = session.exec(
+                    select(Incident.id, Incident.payload)
+                    .where(Incident.id > last_id, Incident.geo_cell.is_(None), Incident.payload.isnot(None))
+                    .order_by(Incident.id).limit(chunk_size)
+                ).all()
+                if not rows:
+                    break
+                for incident_id, payload in rows:
+                    try:
+                        event = json.loads(payload)
+                    except ValueError:
+                        continue
+                    lat, lon = location_of(event) if isinstance(event, dict) else (None, None)
+                    if lat is not None:
+                        session.exec(update(Incident).where(Incident.id == incident_id)
+                                     .values(lat=lat, lon=lon, geo_cell=cell_of(lat, lon)))
+                        updated += 1
+                session.commit()
+                last_id = rows[-1].id
+    return updated
+
+
+if __name__ == "__main__":
+    from db import init_db
+
+    init_db()
+    if sys.argv[1:] == ["backfill"]:
+        print(f"located {backfill()} incidents")
+    else:
+        print(__doc__)
+        sys.exit(2)
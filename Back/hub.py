@@ -0,0 +1,71 @@
+"""In-process fan-out of new incidents to live subscribers (SSE).
+
+Publishing is a non-blocking put into each matching subscriber's bounded
+queue, so the cost of a new incident does not depend on how slow any
+dashboard is, and subscribers never touch the database. A subscriber whose
+queue is full is dropped (its stream ends with a "dropped" event and the
+client reconnects, then catches up through GET /api/v1/incidents).
+"""
+import asyncio
+from typing import Dict, Iterable, Optional, Set
+
+SUBSCRIBER_BUFFER = 256
+
+
+class Subscription:
+    def __init__(self, severities: Optional[Set[str]], device_ids: Optional[Set[str]], maxsize: int):
+        self.severities = severities
+        self.device_ids = device_ids
+        self.queue: "asyncio.Queue[Optional[Dict]]" = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    def matches(self, incident: Dict) -> bool:
+        if self.severities and incident["severity"] not in self.severities:
+            return False
+        if self.device_ids and incident["device_id"] not in self.device_ids:
+            return False
+        return True
+
+    async def next(self) -> Optional[Dict]:
+        """Next incident, or None once the hub has dropped this subscriber."""
+        return await self.queue.get()
+
+
+class BroadcastHub:
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER):
+        self.buffer_size = buffer_size
+        self._subscribers: Set[Subscription] = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, severities: Optional[Iterable[str]] = None,
+                  device_ids: Optional[Iterable[str]] = None) -> Subscription:
+        sub = Subscription(set(severities or ()), set(device_ids or ()), self.buffer_size)
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self._subscribers.discard(sub)
+
+    def publish(self, incident: Dict) -> None:
+        """Deliver `incident` to every matching subscriber; must run on the event loop."""
+        self.published += 1
+        for sub in list(self._subscribers):
+            if not sub.matches(incident):
+                continue
+            try:
+                sub.queue.put_nowait(incident)
+            except asyncio.QueueFull:
+                self._drop(sub)
+
+    def _drop(self, sub: Subscription) -> None:
+        self._subscribers.discard(sub)
+        self.dropped += 1
+        sub.dropped = True
+        # make room for the end-of-stream marker; the client will resync anyway
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"subscribers": len(self._subscribers), "published": self.published, "dropped": self.dropped}
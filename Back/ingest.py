@@ -0,0 +1,317 @@
+"""Write-behind ingestion queue with group commits.
+
+Requests enqueue scored events and the queue's worker writes them in batches:
+a flush happens once `max_batch` rows are waiting or `max_delay` seconds after
+the first row of the batch arrived, whichever comes first. One commit (one
+fsync) then covers every request in the batch.
+If that commit fails, the error is logged and the batch's requests are
+retried one transaction each, so only the request with the bad rows fails.
+
+Durability modes (``durability`` query parameter on the ingest endpoints):
+- ``sync`` (default): the request waits until the group commit containing its
+  events has succeeded, so the response is a durable acknowledgement (with
+  the default `synchronous=FULL`, see db.py) and carries the incident ids.
+- ``async``: the request is acknowledged as soon as the events are queued
+  (HTTP 202). Events still in the queue are lost if the process dies, and no
+  incident ids are returned.
+
+With several storage shards (see `db.SHARD_COUNT`) a batch is split by device
+and each shard commits its part on its own writer, concurrently. A batch
+request is then atomic per shard rather than as a whole; retries are safe
+when events carry an `event_id`.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, tuple_
+from sqlmodel import Session, select
+
+import eventstore
+import geo
+import metrics
+import rollups
+from db import IN_CLAUSE_CHUNK, run_shard_write, shard_engines, shard_for, to_global_id
+from models import Incident
+
+log = logging.getLogger(__name__)
+
+DURABILITY_MODES = ("sync", "async")
+RECENT_EVENT_CAPACITY = 100_000
+
+EventKey = Tuple[str, str]
+
+
+class ScoredEvent(NamedTuple):
+    event: Dict
+    device_id: str
+    timestamp: object
+    score: float
+    severity: str
+    ruleset_version: Optional[str] = None
+    # device-supplied id; retries with the same id are stored once
+    event_id: Optional[str] = None
+
+    @property
+    def key(self) -> Optional[EventKey]:
+        return (self.device_id, self.event_id) if self.event_id else None
+
+
+class WriteResult(NamedTuple):
+    incident_id: Optional[int]
+    duplicate: bool = False
+
+
+class RecentEvents:
+    """Bounded LRU of recently committed (device_id, event_id) -> ingest response.
+
+    Lets retried events be answered without queueing or touching the database;
+    anything that falls out of it is still caught by the unique index lookup
+    in `write_events`.
+    """
+
+    def __init__(self, capacity: int = RECENT_EVENT_CAPACITY):
+        self.capacity = capacity
+        self._entries: "OrderedDict[EventKey, Dict]" = OrderedDict()
+        self.hits = 0
+
+    def get(self, key: EventKey) -> Optional[Dict]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key: EventKey, value: Dict) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _stored_events(session: Session, items: List[ScoredEvent]) -> Dict[EventKey, Optional[int]]:
+    """Which keyed `items` are already stored, mapped to their incident id (if any).
+
+    Each key is looked up in the event partition of its own day.
+    """
+    by_day: Dict[object, List[EventKey]] = {}
+    for item in items:
+        if item.key is not None:
+            by_day.setdefault(item.timestamp.date(), []).append(item.key)
+    found: Dict[EventKey, Optional[int]] = {}
+    for day, keys in by_day.items():
+        events = eventstore.ensure_partition(session, day)
+        for start in range(0, len(keys), IN_CLAUSE_CHUNK):
+            chunk = keys[start:start + IN_CLAUSE_CHUNK]
+            q = (
+                select(events.c.device_id, events.c.event_id, Incident.id)
+                .outerjoin(Incident, and_(Incident.device_id == events.c.device_id,
+                                          Incident.event_id == events.c.event_id))
+                .where(tuple_(events.c.device_id, events.c.event_id).in_(chunk))
+            )
+            for device_id, event_id, incident_id in session.exec(q):
+                found[(device_id, event_id)] = incident_id
+    return found
+
+
+def write_events(session: Session, items: List[ScoredEvent]) -> List[WriteResult]:
+    """Add event partition (and Incident) rows for `items`, bump rollups, and flush.
+
+    Items whose (device_id, event_id) is already stored, or repeated within
+    `items`, are not written again; their result points at the original
+    incident. The caller owns the transaction and must commit.
+    """
+    stored = _stored_events(session, items)
+    first_seen: Dict[EventKey, int] = {}
+    incidents = []
+    deltas = {}
+    event_rows: Dict[object, List[Dict]] = {}
+    for idx, item in enumerate(items):
+        key = item.key
+        if key is not None and (key in stored or key in first_seen):
+            incidents.append(None)
+            continue
+        if key is not None:
+            first_seen[key] = idx
+        event_rows.setdefault(item.timestamp.date(), []).append({
+            "event_id": item.event_id or str(uuid.uuid4()), "device_id": item.device_id,
+            "timestamp": item.timestamp, "event": item.event, "score": item.score,
+            "severity": item.severity, "ruleset_version": item.ruleset_version,
+        })
+        inc = None
+        if item.severity in ("moderate", "high"):
+            lat, lon = geo.location_of(item.event)
+            inc = Incident(device_id=item.device_id, timestamp=item.timestamp, score=item.score, severity=item.severity,
+                           payload=json.dumps(item.event), ruleset_version=item.ruleset_version,
+                           event_id=item.event_id, lat=lat, lon=lon, geo_cell=geo.cell_of(lat, lon))
+            session.add(inc)
+            rollups.accumulate(deltas, item.device_id, item.timestamp, item.severity, item.score)
+        incidents.append(inc)
+    for day, rows in event_rows.items():
+        eventstore.insert_rows(session, eventstore.ensure_partition(session, day), rows)
+    rollups.apply(session, deltas)
+    # flush assigns primary keys without a refresh round-trip per row
+    session.flush()
+
+    results = []
+    for idx, (item, inc) in enumerate(zip(items, incidents)):
+        key = item.key
+        if key in stored:
+            results.append(WriteResult(stored[key], True))
+        elif key is not None and first_seen[key] != idx:
+            original = incidents[first_seen[key]]
+            results.append(WriteResult(original.id if original is not None else None, True))
+        else:
+            results.append(WriteResult(inc.id if inc is not None else None))
+    return results
+
+
+class IngestQueue:
+    """Group-commit queue; `on_commit(items, results)` runs on the loop after each commit."""
+
+    def __init__(self, max_batch: int = 500, max_delay: float = 0.02,
+                 on_commit: Optional[Callable[[List[ScoredEvent], List[WriteResult]], None]] = None):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.recent = RecentEvents()
+        self._queue: "asyncio.Queue" = asyncio.Queue()
+        # rows submitted but not yet written (admission caps this, see admission.py)
+        self.pending_rows = 0
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush whatever is still queued and stop the worker."""
+        if self._worker is None:
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        return {"depth": self.depth(), "pending_rows": self.pending_rows, "recent_events": len(self.recent),
+                "recent_hits": self.recent.hits}
+
+    def submit_nowait(self, items: List[ScoredEvent]) -> "asyncio.Future":
+        """Queue `items` as one unit; the future resolves to their WriteResults after commit."""
+        # routed here, in the caller, so a bad device id fails its own request, not a group commit
+        shards = [shard_for(item.device_id) for item in items]
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((items, shards, fut))
+        self.pending_rows += len(items)
+        return fut
+
+    async def submit(self, items: List[ScoredEvent]) -> List[WriteResult]:
+        """Queue `items` and wait for the group commit that persists them."""
+        return await self.submit_nowait(items)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            rows = len(first[0])
+            deadline = loop.time() + self.max_delay
+            # a submission is never split across batches, so a batch request
+            # stays one transaction per shard
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+                rows += len(nxt[0])
+            await self._flush(batch)
+
+    async def _flush(self, batch) -> None:
+        outcomes = await self._write([(items, shards) for items, shards, _ in batch])
+        self.pending_rows -= sum(len(items) for items, _, _ in batch)
+        for (items, _, fut), outcome in zip(batch, outcomes):
+            if isinstance(outcome, Exception):
+                if not fut.done():
+                    fut.set_exception(outcome)
+                    # mark retrieved so "async" submissions do not log "never retrieved"
+                    fut.exception()
+                continue
+            for item, result in zip(items, outcome):
+                if item.key is not None:
+                    self.recent.put(item.key, {"risk_score": item.score, "severity": item.severity,
+                                               "incident_id": result.incident_id,
+                                               "ruleset_version": item.ruleset_version})
+            if not fut.done():
+                fut.set_result(outcome)
+            if self.on_commit is not None:
+                self.on_commit(items, outcome)
+
+    async def _write(self, submissions: List[Tuple[List[ScoredEvent], List[int]]]) -> List:
+        """Write the submissions; per submission, its WriteResults or the exception that failed it.
+
+        Each shard commits its part of the group at once. When that commit
+        fails and it held several submissions, they are retried one per
+        transaction, so only the submission that caused the error fails.
+        """
+        # shard -> [(submission index, item index)]
+        by_shard: Dict[int, List[Tuple[int, int]]] = {}
+        for sub, (_, shards) in enumerate(submissions):
+            for idx, shard in enumerate(shards):
+                by_shard.setdefault(shard, []).append((sub, idx))
+        results: List[List[Optional[WriteResult]]] = [[None] * len(items) for items, _ in submissions]
+        failed: Dict[int, Exception] = {}
+
+        async def write(shard: int, members: List[Tuple[int, int]]) -> None:
+            items = [submissions[sub][0][idx] for sub, idx in members]
+            try:
+                written = await run_shard_write(shard, self._write_shard, shard, items)
+            except Exception as exc:
+                subs = sorted({sub for sub, _ in members})
+                if len(subs) == 1:
+                    log.exception("write of %d events to shard %d failed", len(items), shard)
+                    failed.setdefault(subs[0], exc)
+                    return
+                log.warning("group commit of %d submissions to shard %d failed (%s); retrying them one by one",
+                            len(subs), shard, exc)
+                for sub in subs:
+                    await write(shard, [m for m in members if m[0] == sub])
+                return
+            for (sub, idx), result in zip(members, written):
+                results[sub][idx] = result
+
+        await asyncio.gather(*(write(shard, members) for shard, members in by_shard.items()))
+        return [failed.get(sub, results[sub]) for sub in range(len(submissions))]
+
+    @staticmethod
+    def _write_shard(shard: int, items: List[ScoredEvent]) -> List[WriteResult]:
+        with Session(shard_engines[shard]) as session:
+            started = time.perf_counter()
+            results = write_events(session, items)
+            written = time.perf_counter()
+            session.commit()
+        metrics.observe_phase("flush_write", written - started)
+        metrics.observe_phase("flush_commit", time.perf_counter() - written)
+        return [
+            WriteResult(to_global_id(shard, r.incident_id) if r.incident_id is not None else None, r.duplicate)
+            for r in results
+        ]
@@ -1,18 +1,51 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Query, Request, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlmodel import SQLModel, Session, create_engine, select
-from typing import Optional, List
+from starlette.background import BackgroundTask
+from sqlalchemy import tuple_, update
+from sqlmodel import Session, select
+from typing import Dict, NamedTuple, Optional, List
 from datetime import datetime
-import uuid
+import asyncio
+import base64
+import heapq
+import itertools
+from collections import Counter
+import os
 import json
-from models import Device, Event, Incident
-from rules import compute_risk, severity_from_score
-from storage import save_thumbnail
+import logging
+import time
+from models import Device, Incident, Snapshot, Thumbnail
+from rules import compute_risk_batch_tolerant, registry as rule_registry
+from storage import Upload, UploadTooLarge, delete_blob, discard_upload, is_sha256, store_blob, stream_upload
+from db import (IN_CLAUSE_CHUNK, SHARD_COUNT, dispose_all, engine, executor_backlog, gather_shards, init_db,
+                run_read, run_shard_write, run_write, shard_engines, shard_for, split_global_id, to_global_id)
+import eventstore
+import export
+import geo
+import metrics
+import packstore
+import rollups
+from hub import BroadcastHub
+from config_cache import DeviceConfigCache
+from admission import AdmissionController, RateLimited
+import thumbnails
+from ingest import DURABILITY_MODES, IngestQueue, ScoredEvent, WriteResult
 
-DB_FILE = "sqlite:///./fastapi_prototype.db"
-engine = create_engine(DB_FILE, echo=False)
+log = logging.getLogger(__name__)
 
 app = FastAPI(title="Driving Risk Prototype API")
+ingest_queue: Optional[IngestQueue] = None
+incident_hub = BroadcastHub()
+admission = AdmissionController()
+maintenance_task: Optional[asyncio.Task] = None
+rule_refresh_task: Optional[asyncio.Task] = None
+
+# how often thumbnail compaction and pack retention run (0 disables)
+MAINTENANCE_INTERVAL = float(os.environ.get("SAFENET_MAINTENANCE_INTERVAL", "3600"))
+# how often per-device rule overrides are reloaded from the database, so
+# config writes served by other API processes take effect here (0 disables)
+RULE_REFRESH_INTERVAL = float(os.environ.get("SAFENET_RULE_REFRESH_INTERVAL", "10"))
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,24 +53,356 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # the Dashboard pages with X-Next-Cursor and revalidates thumbnails/configs by ETag
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+for _shard, _engine in enumerate(shard_engines):
+    metrics.instrument_engine(_engine, "main" if _engine is engine else f"shard{_shard}")
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    return JSONResponse({"detail": str(exc), "limit": exc.limit}, status_code=429,
+                        headers={"Retry-After": exc.retry_after_header})
+
+
+def _admit_events(costs: Dict[str, int]) -> None:
+    """Admission for ingest: room in the write-behind queue, then the devices' token buckets."""
+    admission.check_queue(ingest_queue.pending_rows, sum(costs.values()))
+    admission.admit(costs)
+
+
+async def ingest_slot():
+    """Dependency holding a global in-flight ingest slot for the whole request."""
+    async with admission.slot():
+        yield
 
 
 @app.on_event("startup")
-def on_startup():
-    SQLModel.metadata.create_all(engine)
+async def on_startup():
+    global ingest_queue, maintenance_task, rule_refresh_task
+    init_db()
+    await run_read(_load_device_rule_overrides)
+    ingest_queue = IngestQueue(on_commit=_publish_incidents)
+    ingest_queue.start()
+    metrics.add_collector("ingest", ingest_queue.stats)
+    if MAINTENANCE_INTERVAL > 0:
+        maintenance_task = asyncio.get_running_loop().create_task(_storage_maintenance())
+    if RULE_REFRESH_INTERVAL > 0:
+        rule_refresh_task = asyncio.get_running_loop().create_task(_refresh_rule_overrides())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if maintenance_task is not None:
+        maintenance_task.cancel()
+    if rule_refresh_task is not None:
+        rule_refresh_task.cancel()
+    if ingest_queue is not None:
+        await ingest_queue.stop()
+    thumbnails.shutdown()
+    dispose_all()
+
+
+async def _storage_maintenance():
+    """Periodically pack old thumbnails, expire packs and event partitions past retention.
+
+    Each step is one small batch on a DB writer, so ingestion keeps
+    flowing between them.
+    """
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            while await run_write(packstore.compact_batch):
+                pass
+            while await run_write(packstore.expire_one_pack):
+                pass
+            for shard, shard_engine in enumerate(shard_engines):
+                dropped = await run_shard_write(shard, eventstore.expire_partitions, shard_engine)
+                if dropped:
+                    log.info("dropped event partitions %s", ", ".join(dropped))
+        except Exception:
+            log.exception("storage maintenance failed")
+
+
+async def _refresh_rule_overrides():
+    while True:
+        await asyncio.sleep(RULE_REFRESH_INTERVAL)
+        try:
+            await run_read(_load_device_rule_overrides)
+        except Exception:
+            log.exception("refreshing device rule overrides failed")
+
+
+def _publish_incidents(items: List[ScoredEvent], results: List[WriteResult]) -> None:
+    for item, result in zip(items, results):
+        if result.incident_id is not None and not result.duplicate:
+            incident_hub.publish({
+                "id": result.incident_id,
+                "device_id": item.device_id,
+                "timestamp": item.timestamp.isoformat(),
+                "score": item.score,
+                "severity": item.severity,
+                "ruleset_version": item.ruleset_version,
+            })
+
+
+def _load_device_rule_overrides() -> None:
+    with Session(engine) as session:
+        rows = session.exec(
+            select(Device.device_id, Device.config, Device.config_version).where(Device.config.isnot(None))
+        ).all()
+    for dev_id, config, version in rows:
+        try:
+            rule_registry.set_device_overrides(dev_id, json.loads(config).get("rules"), version or 0)
+        except (ValueError, AttributeError):
+            pass
 
 
 @app.post("/api/v1/snapshots")
-async def upload_snapshot(device_id: str = Form(...), timestamp: str = Form(...), file: UploadFile = File(...)):
-    # save file
-    filename = f"{device_id}_{int(datetime.utcnow().timestamp())}_{uuid.uuid4().hex[:8]}_{file.filename}"
-    relpath, size = await save_thumbnail(file, filename)
-    return {"path": relpath, "size": size}
+async def upload_snapshot(
+    device_id: str = Form(...),
+    timestamp: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    sha256: Optional[str] = Form(None),
+    _slot: None = Depends(ingest_slot),
+):
+    """Store a snapshot thumbnail, deduplicated by content hash.
+
+    Devices may send `sha256` first: when that content is already stored the
+    snapshot just takes a reference to it and no file needs to be uploaded.
+    """
+    if sha256 is not None and not is_sha256(sha256):
+        raise HTTPException(status_code=400, detail="sha256 must be 64 lowercase hex digits")
+    admission.admit({device_id: 1})
+    ts = _parse_event_ts(timestamp)
+
+    if sha256 is not None:
+        ref = await run_write(_add_snapshot_ref, device_id, ts, sha256, None, None)
+        if ref is not None:
+            return ref
+        if file is None:
+            raise HTTPException(status_code=404, detail="unknown sha256, upload the file")
+    elif file is None:
+        raise HTTPException(status_code=400, detail="file or sha256 required")
+
+    try:
+        upload = await stream_upload(file)
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+    metrics.count_upload(upload.size)
+    if sha256 is not None and upload.sha256 != sha256:
+        discard_upload(upload)
+        raise HTTPException(status_code=400, detail="sha256 does not match the uploaded content")
+    try:
+        return await run_write(_add_snapshot_ref, device_id, ts, upload.sha256, upload, file.content_type)
+    except BaseException:
+        discard_upload(upload)
+        raise
+
+
+def _add_snapshot_ref(device_id: str, ts: datetime, sha256: str, upload: Optional[Upload],
+                      content_type: Optional[str]) -> Optional[dict]:
+    """Record a snapshot referencing blob `sha256`, storing `upload` if the blob is new.
+
+    Runs on the DB writer, which also serialises blob creation and deletion.
+    Returns None when no upload was given and the blob is unknown.
+    """
+    now = datetime.utcnow()
+    with Session(engine) as session:
+        thumb = session.get(Thumbnail, sha256)
+        if thumb is None:
+            if upload is None:
+                return None
+            relpath, created = store_blob(upload)
+            thumb = Thumbnail(sha256=sha256, relpath=relpath, size=upload.size, content_type=content_type)
+        else:
+            created = False
+            if upload is not None:
+                discard_upload(upload)
+            # a blob that is referenced again must not age out of its pack
+            packstore.touch(session, thumb.relpath, now)
+        thumb.refcount += 1
+        thumb.last_referenced_at = now
+        snap = Snapshot(device_id=device_id, timestamp=ts, sha256=sha256)
+        session.add(thumb)
+        session.add(snap)
+        session.flush()
+        out = {"id": snap.id, "path": thumb.relpath, "size": thumb.size, "sha256": sha256, "deduplicated": not created}
+        session.commit()
+    return out
+
+
+@app.delete("/api/v1/snapshots/{snapshot_id}")
+async def delete_snapshot(snapshot_id: int):
+    """Drop a snapshot; its blob is deleted once no snapshot references it."""
+    if not await run_write(_release_snapshot, snapshot_id):
+        raise HTTPException(status_code=404, detail="snapshot not found")
+    return {"id": snapshot_id, "status": "deleted"}
+
+
+def _release_snapshot(snapshot_id: int) -> bool:
+    with Session(engine) as session:
+        snap = session.get(Snapshot, snapshot_id)
+        if snap is None:
+            return False
+        thumb = session.get(Thumbnail, snap.sha256)
+        session.delete(snap)
+        orphaned = False
+        if thumb is not None:
+            thumb.refcount -= 1
+            orphaned = thumb.refcount <= 0
+            if orphaned:
+                session.delete(thumb)
+                packstore.forget(session, thumb.relpath)
+            else:
+                session.add(thumb)
+        session.commit()
+        if orphaned:
+            delete_blob(snap.sha256)
+            thumbnails.purge_variants(snap.sha256)
+    return True
+
+
+@app.api_route("/api/v1/thumbnails/{sha256}", methods=["GET", "HEAD"])
+async def get_thumbnail(sha256: str, request: Request, size: Optional[int] = Query(None)):
+    """Serve a thumbnail (or a resized variant with `size`, see VARIANT_SIZES).
+
+    Supports strong ETags with If-None-Match (304) and single byte ranges (206).
+    """
+    if not is_sha256(sha256):
+        raise HTTPException(status_code=400, detail="sha256 must be 64 lowercase hex digits")
+    if size is not None and size not in thumbnails.VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of {thumbnails.VARIANT_SIZES}")
+    found = await run_read(_locate_thumbnail, sha256)
+    if found is None:
+        raise HTTPException(status_code=404, detail="thumbnail not found")
+    content_type, loc = found
+
+    etag = f'"{sha256}"' if size is None else f'"{sha256}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable", "Accept-Ranges": "bytes"}
+    if thumbnails.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if size is not None:
+        path = thumbnails.variant_path(sha256, size)
+        if not path.exists():
+            source = await run_read(packstore.read_location, loc)
+            try:
+                path = await thumbnails.get_variant(sha256, size, source)
+            except ImportError:
+                raise HTTPException(status_code=501, detail="resizing requires Pillow")
+            except OSError:
+                raise HTTPException(status_code=422, detail="thumbnail is not a resizable image")
+        loc = packstore.BlobLocation(path, 0, path.stat().st_size)
+        content_type = "image/jpeg"
+
+    try:
+        byte_range = thumbnails.parse_range(request.headers.get("range"), loc.length)
+    except thumbnails.RangeNotSatisfiable:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{loc.length}"})
+    media_type = content_type or "application/octet-stream"
+    if byte_range is None:
+        return thumbnails.BlobResponse(loc.path, loc.offset, loc.length, headers=headers, media_type=media_type)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{loc.length}"
+    return thumbnails.BlobResponse(loc.path, loc.offset + start, end - start + 1, status_code=206,
+                                   headers=headers, media_type=media_type)
+
+
+def _locate_thumbnail(sha256: str):
+    with Session(engine) as session:
+        thumb = session.get(Thumbnail, sha256)
+        if thumb is None:
+            return None
+        loc = packstore.locate(thumb.relpath, session)
+        return (thumb.content_type, loc) if loc is not None else None
+
+
+def _parse_event_ts(ts_raw: str) -> datetime:
+    try:
+        return datetime.fromisoformat(ts_raw.replace("Z", "+00:00"))
+    except Exception:
+        return datetime.utcnow()
+
+
+# a batch beyond either cap is refused with 413 before any of it is parsed or scored
+BATCH_MAX_EVENTS = int(os.environ.get("SAFENET_BATCH_MAX_EVENTS", "5000"))
+BATCH_MAX_BYTES = int(os.environ.get("SAFENET_BATCH_MAX_BYTES", 8 * 1024 * 1024))
+
+
+async def _read_batch_body(request: Request) -> bytes:
+    """The request body, streamed so an oversized one is refused without buffering it."""
+    too_large = HTTPException(status_code=413, detail=f"batch body larger than {BATCH_MAX_BYTES} bytes")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > BATCH_MAX_BYTES:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > BATCH_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _parse_batch_body(body: bytes) -> List:
+    """Decode a batch body sent either as a JSON array or as NDJSON."""
+    text = body.decode("utf-8").strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        return items
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+EVENT_ID_MAX_LENGTH = 128
+DEVICE_ID_MAX_LENGTH = 128
+
+
+def _device_id(event: dict) -> str:
+    """The event's device id; raises ValueError unless it is a non-empty string."""
+    device_id = event.get("device_id")
+    if not isinstance(device_id, str) or not device_id or len(device_id) > DEVICE_ID_MAX_LENGTH:
+        raise ValueError(f"device_id must be a non-empty string of at most {DEVICE_ID_MAX_LENGTH} characters")
+    return device_id
+
+
+def _event_id(event: dict) -> Optional[str]:
+    """The device-supplied event id, if any; raises ValueError when malformed."""
+    event_id = event.get("event_id")
+    if event_id is None:
+        return None
+    if not isinstance(event_id, str) or not event_id or len(event_id) > EVENT_ID_MAX_LENGTH:
+        raise ValueError(f"event_id must be a non-empty string of at most {EVENT_ID_MAX_LENGTH} characters")
+    return event_id
+
+
+def durability_mode(durability: str = Query("sync")) -> str:
+    """Dependency validating `?durability=` before the request is admitted or charged."""
+    if durability not in DURABILITY_MODES:
+        raise HTTPException(status_code=400, detail=f"durability must be one of {', '.join(DURABILITY_MODES)}")
+    return durability
+
+
+async def _enqueue(items: List[ScoredEvent], durability: str) -> Optional[List[WriteResult]]:
+    """Hand events to the group-commit queue; returns their write results in "sync" mode."""
+    if durability == "async":
+        ingest_queue.submit_nowait(items)
+        return None
+    started = time.perf_counter()
+    results = await ingest_queue.submit(items)
+    metrics.observe_phase("queue_wait", time.perf_counter() - started)
+    return results
 
 
 @app.post("/api/v1/events")
-async def post_event(background_tasks: BackgroundTasks, event: dict):
+async def post_event(background_tasks: BackgroundTasks, event: dict, durability: str = Depends(durability_mode),
+                     _slot: None = Depends(ingest_slot)):
     # Validate minimal fields
     device_id = event.get("device_id")
     ts_raw = event.get("timestamp")
@@ -45,92 +410,643 @@ async def post_event(background_tasks: BackgroundTasks, event: dict):
         raise HTTPException(status_code=400, detail="device_id and timestamp required")
 
     try:
-        ts = datetime.fromisoformat(ts_raw.replace("Z", "+00:00"))
-    except Exception:
-        ts = datetime.utcnow()
+        _device_id(event)
+        event_id = _event_id(event)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    # a retry of a recently stored event is answered from memory
+    if event_id is not None:
+        cached = ingest_queue.recent.get((device_id, event_id))
+        if cached is not None:
+            return dict(cached, duplicate=True)
 
-    # compute risk
-    score = compute_risk(event)
-    severity = severity_from_score(score)
+    ts = _parse_event_ts(ts_raw)
 
-    # store event and maybe incident
-    with Session(engine) as session:
-        ev = Event(event_id=str(uuid.uuid4()), device_id=device_id, timestamp=ts, payload=json.dumps(event))
-        session.add(ev)
-        session.commit()
-        session.refresh(ev)
+    # compute risk with the device's ruleset (base rules plus its overrides)
+    started = time.perf_counter()
+    ruleset = rule_registry.for_device(device_id)
+    try:
+        score = ruleset.score(event)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"invalid event field: {exc}")
+    severity = ruleset.severity(score)
+    metrics.observe_phase("score", time.perf_counter() - started)
+    # charged only once the event is known to be storable
+    _admit_events({device_id: 1})
+
+    # store event and maybe incident (group-committed with concurrent requests)
+    results = await _enqueue([ScoredEvent(event, device_id, ts, score, severity, ruleset.version, event_id)], durability)
+    if results is None:
+        return JSONResponse({"risk_score": score, "severity": severity, "incident_id": None,
+                             "ruleset_version": ruleset.version, "status": "queued"}, status_code=202)
+
+    return {"risk_score": score, "severity": severity, "incident_id": results[0].incident_id,
+            "ruleset_version": ruleset.version, "duplicate": results[0].duplicate}
+
+
+def _score_members(ruleset, members: List) -> None:
+    """Fill the (event, result) pairs' scores; events with unusable fields become per-index errors."""
+    scored, scores, severities, errors = compute_risk_batch_tolerant([event for event, _ in members], ruleset)
+    for pos, error in errors.items():
+        result = members[pos][1]
+        index = result["index"]
+        result.clear()
+        result.update(index=index, error=f"invalid event field: {error}")
+    for pos, score, severity in zip(scored, scores, severities):
+        result = members[pos][1]
+        result["risk_score"] = score
+        result["severity"] = severity
+        result["ruleset_version"] = ruleset.version
+
+
+@app.post("/api/v1/events/batch")
+async def post_events_batch(request: Request, durability: str = Depends(durability_mode),
+                            _slot: None = Depends(ingest_slot)):
+    """Ingest many buffered events at once (JSON array or NDJSON body).
+
+    The accepted events and their incidents are written in one transaction per
+    storage shard (a single transaction with the default of one shard), so with
+    SAFENET_SHARDS > 1 a failure can leave other shards' parts committed;
+    retrying with `event_id`s is safe. The response holds one result per input
+    event, in input order. Bodies over BATCH_MAX_BYTES or with more than
+    BATCH_MAX_EVENTS events are refused with 413.
+    """
+    body = await _read_batch_body(request)
+    started = time.perf_counter()
+    try:
+        events = _parse_batch_body(body)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"invalid batch body: {exc}")
+    metrics.observe_phase("parse", time.perf_counter() - started)
+    if len(events) > BATCH_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX_EVENTS} events per batch")
+
+    results = []
+    valid = []
+    duplicates = 0
+    for idx, event in enumerate(events):
+        if not isinstance(event, dict) or not event.get("device_id") or not event.get("timestamp"):
+            results.append({"index": idx, "error": "device_id and timestamp required"})
+            continue
+        try:
+            _device_id(event)
+            event_id = _event_id(event)
+        except ValueError as exc:
+            results.append({"index": idx, "error": str(exc)})
+            continue
+        cached = ingest_queue.recent.get((event["device_id"], event_id)) if event_id is not None else None
+        if cached is not None:
+            results.append(dict(cached, index=idx, duplicate=True))
+            duplicates += 1
+            continue
+        result = {"index": idx, "risk_score": None, "severity": None, "incident_id": None}
+        results.append(result)
+        valid.append((event, result))
+
+    # one vectorized pass per distinct ruleset (devices with overrides get their own)
+    started = time.perf_counter()
+    groups = {}
+    for event, result in valid:
+        ruleset = rule_registry.for_device(event["device_id"])
+        groups.setdefault(ruleset.version, (ruleset, []))[1].append((event, result))
+    for ruleset, members in groups.values():
+        _score_members(ruleset, members)
+    metrics.observe_phase("score", time.perf_counter() - started)
+    valid = [(event, result) for event, result in valid if "error" not in result]
+    _admit_events(Counter(event["device_id"] for event, _ in valid))
 
-        incident_id = None
-        if severity in ("moderate", "high"):
-            inc = Incident(device_id=device_id, timestamp=ts, score=score, severity=severity, payload=json.dumps(event))
-            session.add(inc)
-            session.commit()
-            session.refresh(inc)
-            incident_id = inc.id
+    pending = [
+        ScoredEvent(event, event["device_id"], _parse_event_ts(event["timestamp"]),
+                    result["risk_score"], result["severity"], result["ruleset_version"], event.get("event_id"))
+        for event, result in valid
+    ]
+    accepted = [result for _, result in valid]
+
+    out = {"count": len(events), "accepted": len(pending), "duplicates": duplicates, "results": results}
+    if not pending:
+        return out
+    written = await _enqueue(pending, durability)
+    if written is None:
+        out["status"] = "queued"
+        return JSONResponse(out, status_code=202)
+    for result, write in zip(accepted, written):
+        result["incident_id"] = write.incident_id
+        result["duplicate"] = write.duplicate
+        if write.duplicate:
+            out["accepted"] -= 1
+            out["duplicates"] += 1
+    return out
+
+
+@app.get("/api/v1/rules")
+def get_rules(device_id: Optional[str] = Query(None)):
+    """Active ruleset (with the device's overrides applied when `device_id` is given)."""
+    ruleset = rule_registry.for_device(device_id)
+    return {"version": ruleset.version, "rules": ruleset.definition}
+
+
+INCIDENT_PAGE_DEFAULT = 100
+INCIDENT_PAGE_MAX = 1000
+STREAM_CHUNK_ROWS = 200
 
-    return {"risk_score": score, "severity": severity, "incident_id": incident_id}
+
+def _encode_cursor(ts: datetime, row_id: int) -> str:
+    raw = json.dumps([ts.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts_raw, row_id = json.loads(raw)
+        return datetime.fromisoformat(ts_raw), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
 
 
 @app.get("/api/v1/incidents")
-def list_incidents(from_ts: Optional[str] = Query(None), to_ts: Optional[str] = Query(None), severity: Optional[str] = Query(None)):
-    with Session(engine) as session:
-        q = select(Incident)
-        if from_ts:
-            try:
-                fdt = datetime.fromisoformat(from_ts.replace("Z", "+00:00"))
-                q = q.where(Incident.timestamp >= fdt)
-            except Exception:
-                pass
-        if to_ts:
-            try:
-                tdt = datetime.fromisoformat(to_ts.replace("Z", "+00:00"))
-                q = q.where(Incident.timestamp <= tdt)
-            except Exception:
-                pass
+async def list_incidents(
+    from_ts: Optional[str] = Query(None),
+    to_ts: Optional[str] = Query(None),
+    severity: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    bbox: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(INCIDENT_PAGE_DEFAULT, ge=1, le=INCIDENT_PAGE_MAX),
+):
+    """Page through incidents newest-first.
+
+    The response body is a JSON array streamed in chunks. When more rows may
+    follow, the `X-Next-Cursor` header holds the value to pass as `cursor`
+    for the next page. Every shard (only the device's one with `device_id`)
+    returns its newest `limit` rows and the pages are merged. `bbox` is
+    min_lon,min_lat,max_lon,max_lat; incidents without a location never match.
+    """
+    return await _incident_page(_parse_query_ts(from_ts, "from_ts"), _parse_query_ts(to_ts, "to_ts"), severity,
+                                device_id, _parse_bbox(bbox), cursor, limit)
+
+
+async def _incident_page(from_ts, to_ts, severity, device_id, box, cursor, limit, open_only=False):
+    after = _decode_cursor(cursor) if cursor else None
+    shards = [shard_for(device_id)] if device_id else range(SHARD_COUNT)
+    parts = await gather_shards(_query_incidents, from_ts, to_ts, severity, device_id, box, after, limit,
+                                open_only=open_only, shards=shards)
+    for shard, part in zip(shards, parts):
+        part[:] = [IncidentRow(to_global_id(shard, r.id), *r[1:]) for r in part]
+    merged = heapq.merge(*parts, key=lambda r: (r.timestamp, r.id), reverse=True)
+    rows = list(itertools.islice(merged, limit))
+    headers = {}
+    if len(rows) == limit:
+        last = rows[-1]
+        headers["X-Next-Cursor"] = _encode_cursor(last.timestamp, last.id)
+    return StreamingResponse(_stream_incidents(rows), media_type="application/json", headers=headers)
+
+
+class IncidentRow(NamedTuple):
+    id: int
+    device_id: str
+    timestamp: datetime
+    score: float
+    severity: str
+    thumbnail_path: Optional[str]
+    ruleset_version: Optional[str]
+    lat: Optional[float]
+    lon: Optional[float]
+    acked_at: Optional[datetime]
+    acked_by: Optional[str]
+
+
+def _parse_bbox(raw: Optional[str]) -> Optional[geo.BBox]:
+    if not raw:
+        return None
+    try:
+        return geo.parse_bbox(raw)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+def _query_incidents(shard: int, from_ts: Optional[datetime], to_ts: Optional[datetime], severity: Optional[str],
+                     device_id: Optional[str], box: Optional[geo.BBox], after, limit: int,
+                     open_only: bool = False) -> List:
+    with Session(shard_engines[shard]) as session:
+        # only the listed columns; the JSON payload stays on disk
+        q = select(Incident.id, Incident.device_id, Incident.timestamp, Incident.score,
+                   Incident.severity, Incident.thumbnail_path, Incident.ruleset_version, Incident.lat, Incident.lon,
+                   Incident.acked_at, Incident.acked_by)
+        if open_only:
+            # matches the partial index's WHERE, so only open rows are scanned
+            q = q.where(Incident.acked_at.is_(None))
+        if from_ts is not None:
+            q = q.where(Incident.timestamp >= from_ts)
+        if to_ts is not None:
+            q = q.where(Incident.timestamp <= to_ts)
         if severity:
             q = q.where(Incident.severity == severity)
-        rows = session.exec(q).all()
-        out = []
-        for r in rows:
-            out.append({
+        if device_id:
+            q = q.where(Incident.device_id == device_id)
+        if box is not None:
+            q = q.where(geo.bbox_clause(box))
+        if after is not None:
+            # cursor ids are global: local id < bound <=> to_global_id(shard, id) < after id
+            after_ts, after_id = after
+            bound = (after_id - shard + SHARD_COUNT - 1) // SHARD_COUNT
+            q = q.where(tuple_(Incident.timestamp, Incident.id) < tuple_(after_ts, bound))
+        q = q.order_by(Incident.timestamp.desc(), Incident.id.desc()).limit(limit)
+        return session.exec(q).all()
+
+
+async def _stream_incidents(rows):
+    yield "["
+    for start in range(0, len(rows), STREAM_CHUNK_ROWS):
+        chunk = [
+            json.dumps({
                 "id": r.id,
                 "device_id": r.device_id,
                 "timestamp": r.timestamp.isoformat(),
                 "score": r.score,
                 "severity": r.severity,
                 "thumbnail": r.thumbnail_path,
+                "ruleset_version": r.ruleset_version,
+                "lat": r.lat,
+                "lon": r.lon,
+                "acked_at": r.acked_at.isoformat() if r.acked_at else None,
+                "acked_by": r.acked_by,
             })
-        return out
+            for r in rows[start:start + STREAM_CHUNK_ROWS]
+        ]
+        yield ("," if start else "") + ",".join(chunk)
+    yield "]"
+
+
+@app.get("/api/v1/incidents/heatmap")
+async def incident_heatmap(
+    bbox: Optional[str] = Query(None),
+    cell_deg: float = Query(geo.GRID_DEG, ge=geo.GRID_DEG, le=45.0),
+    from_ts: Optional[str] = Query(None),
+    to_ts: Optional[str] = Query(None),
+    severity: Optional[str] = Query(None),
+):
+    """Incident counts per grid cell (`cell_deg` degrees, rounded to a multiple of the index grid).
+
+    Cells are listed busiest first, each with its centre, count, average and
+    max score; only incidents with a location are counted.
+    """
+    box = _parse_bbox(bbox)
+    fdt = _parse_query_ts(from_ts, "from_ts")
+    tdt = _parse_query_ts(to_ts, "to_ts")
+    parts = await gather_shards(_query_heatmap, box, fdt, tdt, severity)
+    return geo.merge_heatmap(parts, cell_deg)
+
+
+def _query_heatmap(shard: int, box, from_ts, to_ts, severity) -> List[tuple]:
+    with Session(shard_engines[shard]) as session:
+        return geo.heatmap_cells(session, box, from_ts, to_ts, severity)
+
+
+SSE_HEARTBEAT_SECONDS = 15.0
+
+
+@app.get("/api/v1/incidents/stream")
+async def stream_incidents(severity: Optional[str] = Query(None), device_id: Optional[str] = Query(None)):
+    """Server-Sent Events feed of new incidents.
+
+    `severity` and `device_id` take comma-separated values. Slow clients are
+    dropped (a final `dropped` event) rather than buffered without bound.
+    """
+    sub = incident_hub.subscribe(
+        severities=[v for v in (severity or "").split(",") if v],
+        device_ids=[v for v in (device_id or "").split(",") if v],
+    )
+    return StreamingResponse(
+        _sse_events(sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _sse_events(sub):
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                incident = await asyncio.wait_for(sub.next(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            if incident is None:
+                yield "event: dropped\ndata: {}\n\n"
+                return
+            yield f"id: {incident['id']}\nevent: incident\ndata: {json.dumps(incident)}\n\n"
+    finally:
+        incident_hub.unsubscribe(sub)
+
+
+@app.get("/api/v1/admission")
+def admission_stats():
+    """Admission-control counters: admitted requests and rejections per limit."""
+    return dict(admission.stats(), queued_rows=ingest_queue.pending_rows)
+
+
+metrics.add_collector("admission", admission.stats)
+metrics.add_collector("sse", incident_hub.stats)
+metrics.add_collector("db_executor_backlog", executor_backlog)
+
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Prometheus text exposition of request, DB and ingest metrics."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/v1/debug/metrics")
+def debug_metrics():
+    """The /metrics data as JSON, with per-series count, mean and bucket p50/p95/p99."""
+    return metrics.render_json()
+
+
+STATS_LIMIT_MAX = 10000
+
+
+@app.get("/api/v1/stats")
+async def incident_stats(
+    granularity: str = Query("hour"),
+    from_ts: Optional[str] = Query(None),
+    to_ts: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    severity: Optional[str] = Query(None),
+    group_by: str = Query("bucket"),
+    limit: int = Query(1000, ge=1, le=STATS_LIMIT_MAX),
+):
+    """Incident counts and scores aggregated from the rollup tables.
+
+    `group_by` is a comma-separated subset of bucket, device_id and severity
+    (empty for a single total over the range).
+    """
+    if granularity not in rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(rollups.GRANULARITIES)}")
+    fields = [f.strip() for f in group_by.split(",") if f.strip()]
+    if any(f not in rollups.GROUP_FIELDS for f in fields):
+        raise HTTPException(status_code=400, detail=f"group_by fields must be among {', '.join(rollups.GROUP_FIELDS)}")
+    fdt = _parse_query_ts(from_ts, "from_ts")
+    tdt = _parse_query_ts(to_ts, "to_ts")
+    shards = [shard_for(device_id)] if device_id else None
+    parts = await gather_shards(_query_stats, granularity, fdt, tdt, device_id, severity, fields, limit, shards=shards)
+    return rollups.merge(parts, fields, limit)
+
+
+def _parse_query_ts(raw: Optional[str], name: str) -> Optional[datetime]:
+    if not raw:
+        return None
+    try:
+        return datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO 8601 timestamp")
+
+
+def _query_stats(shard: int, granularity, from_ts, to_ts, device_id, severity, fields, limit) -> List[dict]:
+    with Session(shard_engines[shard]) as session:
+        return rollups.query(session, granularity, from_ts, to_ts, device_id, severity, fields, limit)
+
+
+EXPORT_RETRY_AFTER = 10.0
+export_slots = export.ExportSlots()
+metrics.add_collector("export", export_slots.stats)
+
+
+@app.get("/api/v1/export/{kind}")
+async def export_rows(
+    kind: str,
+    fmt: str = Query("ndjson", alias="format"),
+    from_ts: Optional[str] = Query(None),
+    to_ts: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    severity: Optional[str] = Query(None),
+    payload: bool = Query(False),
+):
+    """Stream all incidents or events in a time range as CSV, NDJSON or Parquet.
+
+    Rows come in timestamp order; `payload=true` adds each event's original
+    request (events only). Parquet requires pyarrow. Beyond
+    SAFENET_MAX_EXPORTS concurrent exports the answer is 429.
+    """
+    if kind not in export.KINDS:
+        raise HTTPException(status_code=404, detail=f"kind must be one of {', '.join(export.KINDS)}")
+    try:
+        export.check_format(fmt)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except ImportError:
+        raise HTTPException(status_code=501, detail="parquet export requires pyarrow")
+    chunks = export.iter_export(kind, fmt, _parse_query_ts(from_ts, "from_ts"), _parse_query_ts(to_ts, "to_ts"),
+                                device_id, severity, payload)
+    release = export_slots.acquire()
+    if release is None:
+        raise RateLimited("export", EXPORT_RETRY_AFTER)
+    filename = f"{kind}-{datetime.utcnow():%Y%m%dT%H%M%S}.{fmt}"
+    # the background task also frees the slot when the client leaves before streaming starts
+    return StreamingResponse(_drive_export(chunks, release), media_type=export.MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+                             background=BackgroundTask(release))
+
+
+async def _drive_export(chunks, release):
+    """Pull encoded chunks on the reader pool, one at a time, as the client reads them."""
+    try:
+        while True:
+            chunk = await run_read(next, chunks, None)
+            if chunk is None:
+                return
+            if chunk:
+                yield chunk
+    finally:
+        try:
+            chunks.close()
+        except ValueError:
+            # client went away mid-chunk; the generator is closed once that read returns
+            pass
+        release()
+
+
+CONFIG_POLL_MAX_SECONDS = 60.0
 
 
 @app.post("/api/v1/devices/{device_id}/config")
-def update_device_config(device_id: str, config: dict):
+async def update_device_config(device_id: str, config: dict):
+    rule_overrides = config.get("rules")
+    if rule_overrides is not None and not isinstance(rule_overrides, dict):
+        raise HTTPException(status_code=400, detail="config.rules must be an object")
+    try:
+        rule_registry.validate_overrides(rule_overrides)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    version = await run_write(_store_device_config, device_id, config)
+    rule_registry.set_device_overrides(device_id, rule_overrides, version)
+    config_cache.update(device_id, config, version)
+    return {"device_id": device_id, "config": config, "version": version}
+
+
+def _store_device_config(device_id: str, config: dict) -> int:
     with Session(engine) as session:
         q = select(Device).where(Device.device_id == device_id)
         dev = session.exec(q).first()
         if not dev:
-            dev = Device(device_id=device_id, config=json.dumps(config))
+            dev = Device(device_id=device_id, config=json.dumps(config), config_version=1)
             session.add(dev)
         else:
             dev.config = json.dumps(config)
+            dev.config_version = (dev.config_version or 0) + 1
             session.add(dev)
         session.commit()
-        return {"device_id": device_id, "config": config}
+        return dev.config_version
+
+
+async def _load_device_config(device_id: str) -> Optional[tuple]:
+    return await run_read(_read_device_config, device_id)
+
+
+def _read_device_config(device_id: str) -> Optional[tuple]:
+    with Session(engine) as session:
+        return session.exec(
+            select(Device.config, Device.config_version).where(Device.device_id == device_id)
+        ).first()
+
+
+config_cache = DeviceConfigCache(_load_device_config)
+metrics.add_collector("config_cache", config_cache.stats)
+
+
+def _config_response(device_id: str, entry) -> JSONResponse:
+    return JSONResponse(
+        {"device_id": device_id, "config": entry.config, "version": entry.version},
+        headers={"ETag": entry.etag, "Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/api/v1/devices/{device_id}/config")
+async def get_device_config(device_id: str, request: Request):
+    """Current config from the in-memory cache; honours If-None-Match (304)."""
+    entry = await config_cache.get(device_id)
+    if entry.config is None:
+        raise HTTPException(status_code=404, detail="device has no config")
+    if thumbnails.etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return _config_response(device_id, entry)
+
+
+@app.get("/api/v1/devices/{device_id}/config/poll")
+async def poll_device_config(
+    device_id: str,
+    version: int = Query(0, ge=0),
+    timeout: float = Query(30.0, gt=0, le=CONFIG_POLL_MAX_SECONDS),
+):
+    """Long-poll: answer as soon as the config version differs from `version`.
+
+    Returns 304 if nothing changed within `timeout` seconds; the device then
+    simply polls again with the same version.
+    """
+    entry = await config_cache.wait_for_change(device_id, version, timeout)
+    if entry is None:
+        return Response(status_code=304, headers={"ETag": f'"v{version}"'})
+    return _config_response(device_id, entry)
 
 
 class Ack(BaseException):
     pass
 
 
+ACK_BULK_MAX = 5000
+
+
+def _ack_shard(shard: int, local_ids: List[int], who: str, when: datetime) -> int:
+    """Acknowledge the still-open incidents among `local_ids` in one transaction; returns rows changed."""
+    changed = 0
+    with Session(shard_engines[shard]) as session:
+        for start in range(0, len(local_ids), IN_CLAUSE_CHUNK):
+            result = session.exec(
+                update(Incident)
+                .where(Incident.id.in_(local_ids[start:start + IN_CLAUSE_CHUNK]), Incident.acked_at.is_(None))
+                .values(acked_at=when, acked_by=who)
+                .execution_options(synchronize_session=False)
+            )
+            changed += result.rowcount
+        session.commit()
+    return changed
+
+
+def _ack_state(shard: int, local_id: int):
+    with Session(shard_engines[shard]) as session:
+        return session.exec(select(Incident.acked_at, Incident.acked_by).where(Incident.id == local_id)).first()
+
+
+ALERT_ID_MAX = 2 ** 63 - 1  # SQLite INTEGER range
+
+
+def _alert_ids(raw) -> List[int]:
+    try:
+        ids = [int(v) for v in raw]
+    except (TypeError, ValueError, OverflowError):
+        ids = None
+    if ids is None or any(not 1 <= i <= ALERT_ID_MAX for i in ids):
+        raise HTTPException(status_code=400, detail="alert ids must be incident ids")
+    return ids
+
+
 @app.post("/api/v1/alerts/ack")
-def ack_alert(payload: dict):
-    # minimal ack processing
+async def ack_alert(payload: dict):
+    """Acknowledge one incident; acknowledging it again keeps the first ack."""
     alert_id = payload.get("alert_id")
     who = payload.get("ack_by")
     if not alert_id or not who:
         raise HTTPException(status_code=400, detail="alert_id and ack_by required")
-    # In a full system we'd mark incident/alert as acknowledged.
-    return {"alert_id": alert_id, "ack_by": who, "status": "acknowledged"}
+    (incident_id,) = _alert_ids([alert_id])
+    shard, local_id = split_global_id(incident_id)
+    when = datetime.utcnow()
+    if await run_shard_write(shard, _ack_shard, shard, [local_id], who, when):
+        return {"alert_id": incident_id, "ack_by": who, "acked_at": when.isoformat(), "status": "acknowledged"}
+    state = await run_read(_ack_state, shard, local_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="incident not found")
+    return {"alert_id": incident_id, "ack_by": state.acked_by, "acked_at": state.acked_at.isoformat(),
+            "status": "already_acknowledged"}
+
+
+@app.post("/api/v1/alerts/ack/bulk")
+async def ack_alerts_bulk(payload: dict):
+    """Acknowledge up to ACK_BULK_MAX incidents, one transaction per shard.
+
+    Ids that are unknown or already acknowledged are skipped; `acked` counts
+    the incidents this call acknowledged.
+    """
+    who = payload.get("ack_by")
+    raw_ids = payload.get("alert_ids")
+    if not who or not isinstance(raw_ids, list) or not raw_ids:
+        raise HTTPException(status_code=400, detail="alert_ids (non-empty list) and ack_by required")
+    if len(raw_ids) > ACK_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"at most {ACK_BULK_MAX} alert_ids per request")
+    by_shard = {}
+    for incident_id in set(_alert_ids(raw_ids)):
+        shard, local_id = split_global_id(incident_id)
+        by_shard.setdefault(shard, []).append(local_id)
+    when = datetime.utcnow()
+    counts = await asyncio.gather(*(run_shard_write(shard, _ack_shard, shard, ids, who, when)
+                                    for shard, ids in by_shard.items()))
+    return {"acked": sum(counts), "requested": len(raw_ids), "ack_by": who, "acked_at": when.isoformat()}
+
+
+@app.get("/api/v1/alerts/open")
+async def open_alerts(
+    severity: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(INCIDENT_PAGE_DEFAULT, ge=1, le=INCIDENT_PAGE_MAX),
+):
+    """Unacknowledged incidents newest-first, paged like /api/v1/incidents.
+
+    Served from the partial index on open incidents, so its cost follows the
+    number of open alerts rather than the size of the incident history.
+    """
+    return await _incident_page(None, None, severity, device_id, None, cursor, limit, open_only=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+"""In-process metrics: histograms and counters, rendered for Prometheus or as JSON.
+
+Recording is a bisect plus a few additions under a per-metric lock, cheap
+enough to stay on in production. What gets recorded:
+- HTTP latency per (method, route template, status), from `MetricsMiddleware`;
+- every SQL statement's duration by operation, from cursor hooks installed on
+  each engine with `instrument_engine`;
+- named phases of the ingest path (`observe_phase`): scoring, queue wait,
+  and the write and commit halves of each group commit;
+- uploaded bytes (`count_upload`).
+Gauges (queue depths, admission, hub and cache state) are sampled at scrape
+time from the callables passed to `add_collector`.
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set."""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label set -> [per-bucket counts (+Inf last), sum]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += value
+
+    def snapshot(self) -> Dict[Labels, Tuple[List[int], float]]:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+    def quantile(self, counts: List[int], q: float) -> Optional[float]:
+        """Upper bound of the bucket holding quantile `q` (None when empty or beyond the last bucket)."""
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+http_latency = Histogram("safenet_http_request_duration_seconds", "HTTP request latency by route.", LATENCY_BUCKETS)
+db_latency = Histogram("safenet_db_statement_duration_seconds", "SQL statement execution time.", DB_BUCKETS)
+phase_latency = Histogram("safenet_phase_duration_seconds", "Time spent in named ingest phases.", LATENCY_BUCKETS)
+upload_bytes = CounterMetric("safenet_upload_bytes_total", "Bytes received in snapshot uploads.")
+HISTOGRAMS = (http_latency, db_latency, phase_latency)
+COUNTERS = (upload_bytes,)
+
+_collectors: List[Tuple[str, Callable[[], Dict]]] = []
+_started = time.time()
+
+
+def observe_phase(phase: str, seconds: float) -> None:
+    phase_latency.observe(seconds, phase=phase)
+
+
+def count_upload(nbytes: int) -> None:
+    upload_bytes.inc(nbytes)
+
+
+def add_collector(name: str, collect: Callable[[], Dict]) -> None:
+    """Register `collect()` (a flat dict of numbers, or of dicts of numbers) sampled as gauges."""
+    _collectors.append((name, collect))
+
+
+def instrument_engine(engine, shard: str = "main") -> None:
+    """Time every statement run through `engine`, labelled by shard and SQL operation."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("safenet_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["safenet_query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_latency.observe(time.perf_counter() - started, shard=shard, operation=operation)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        stack = context.connection.info.get("safenet_query_start") if context.connection is not None else None
+        if stack:
+            stack.pop()
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording request latency by route template (not raw path)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_latency.observe(time.perf_counter() - started, method=scope["method"],
+                                 route=getattr(route, "path", "unmatched"), status=str(status[0]))
+
+
+def _gauges() -> Dict[str, List[Tuple[Labels, float]]]:
+    """Collector output as gauge families; nested dicts become a `key` label."""
+    out: Dict[str, List[Tuple[Labels, float]]] = {}
+    for name, collect in _collectors:
+        try:
+            values = collect()
+        except Exception:
+            continue
+        for key, value in values.items():
+            family = out.setdefault(f"safenet_{name}_{key}", [])
+            if isinstance(value, dict):
+                family.extend(((("key", str(sub)),), v) for sub, v in value.items() if isinstance(v, (int, float)))
+            elif isinstance(value, (int, float)):
+                family.append(((), value))
+    return out
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    lines = []
+    for hist in HISTOGRAMS:
+        lines.append(f"# HELP {hist.name} {hist.help}")
+        lines.append(f"# TYPE {hist.name} histogram")
+        for labels, (counts, total) in sorted(hist.snapshot().items()):
+            cumulative = 0
+            for bound, n in zip(hist.buckets, counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f"{hist.name}_bucket{_label_str(labels, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{hist.name}_bucket{_label_str(labels, le)} {cumulative}")
+            lines.append(f"{hist.name}_sum{_label_str(labels)} {total}")
+            lines.append(f"{hist.name}_count{_label_str(labels)} {cumulative}")
+    for counter in COUNTERS:
+        lines.append(f"# HELP {counter.name} {counter.help}")
+        lines.append(f"# TYPE {counter.name} counter")
+        for labels, value in sorted(counter.snapshot().items()):
+            lines.append(f"{counter.name}{_label_str(labels)} {value}")
+    lines.append("# TYPE safenet_uptime_seconds gauge")
+    lines.append(f"safenet_uptime_seconds {time.time() - _started}")
+    for name, series in sorted(_gauges().items()):
+        if not series:
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in series:
+            lines.append(f"{name}{_label_str(labels)} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def render_json() -> Dict:
+    """Same data for humans: histogram count, mean and bucket-bound p50/p95/p99 per series."""
+    out: Dict = {"uptime_seconds": time.time() - _started, "histograms": {}, "counters": {}, "collectors": {}}
+    for hist in HISTOGRAMS:
+        series = []
+        for labels, (counts, total) in sorted(hist.snapshot().items()):
+            n = sum(counts)
+            series.append(dict(labels, count=n, mean=total / n if n else None, p50=hist.quantile(counts, 0.5),
+                               p95=hist.quantile(counts, 0.95), p99=hist.quantile(counts, 0.99)))
+        out["histograms"][hist.name] = series
+    for counter in COUNTERS:
+        out["counters"][counter.name] = [dict(labels, value=v) for labels, v in sorted(counter.snapshot().items())]
+    for name, collect in _collectors:
+        try:
+            out["collectors"][name] = collect()
+        except Exception as exc:
+            out["collectors"][name] = {"error": str(exc)}
+    return out
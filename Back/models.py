@@ -1,3 +1,4 @@
+from sqlalchemy import Index, UniqueConstraint, text
 from sqlmodel import SQLModel, Field
 from typing import Optional
 from datetime import datetime
@@ -5,12 +6,21 @@ from datetime import datetime
 
 class Device(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    device_id: str
+    device_id: str = Field(index=True)
     config: Optional[str] = None
     model_version: Optional[str] = None
+    # bumped on every config write; exposed to devices as the config ETag
+    config_version: Optional[int] = None
 
 
 class Event(SQLModel, table=True):
+    """Legacy event table; new events go to the daily partitions in eventstore.py."""
+    __table_args__ = (
+        Index("ix_event_device_ts", "device_id", "timestamp"),
+        # device-supplied event ids make retries idempotent
+        Index("ux_event_device_event", "device_id", "event_id", unique=True),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     event_id: Optional[str] = None
     device_id: str
@@ -20,6 +30,20 @@ class Event(SQLModel, table=True):
 
 
 class Incident(SQLModel, table=True):
+    # (timestamp, id) is the keyset used to page through incidents newest-first;
+    # the filtered variants keep device / severity queries on an index range too
+    __table_args__ = (
+        Index("ix_incident_ts_id", "timestamp", "id"),
+        Index("ix_incident_device_ts_id", "device_id", "timestamp", "id"),
+        Index("ix_incident_severity_ts_id", "severity", "timestamp", "id"),
+        Index("ix_incident_device_event", "device_id", "event_id"),
+        # bounding-box queries and the heatmap scan geo_cell ranges (see geo.py)
+        Index("ix_incident_geo_cell", "geo_cell", "timestamp"),
+        # partial: only unacknowledged incidents, so open-alert pages stay small as history grows
+        Index("ix_incident_open_ts_id", "timestamp", "id",
+              sqlite_where=text("acked_at IS NULL"), postgresql_where=text("acked_at IS NULL")),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     device_id: str
     timestamp: datetime
@@ -27,3 +51,63 @@ class Incident(SQLModel, table=True):
     severity: str
     thumbnail_path: Optional[str] = None
     payload: Optional[str] = None
+    ruleset_version: Optional[str] = None
+    event_id: Optional[str] = None
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    geo_cell: Optional[int] = None
+    acked_at: Optional[datetime] = None
+    acked_by: Optional[str] = None
+
+
+class Thumbnail(SQLModel, table=True):
+    """A stored thumbnail blob, shared by every snapshot with the same content."""
+    sha256: str = Field(primary_key=True)
+    relpath: str
+    size: int
+    content_type: Optional[str] = None
+    refcount: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+    # bumped by every new snapshot reference; NULL on rows stored before the
+    # column existed until compaction backfills it from created_at
+    last_referenced_at: Optional[datetime] = Field(default=None, index=True)
+
+
+class Snapshot(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    device_id: str = Field(index=True)
+    timestamp: datetime
+    sha256: str = Field(index=True)
+
+
+class Pack(SQLModel, table=True):
+    """An append-only archive file holding old thumbnails (see packstore.py)."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str
+    created_at: datetime
+    size: int = 0
+    newest_blob_at: Optional[datetime] = None  # latest reference to any thumbnail it holds
+
+
+class PackEntry(SQLModel, table=True):
+    relpath: str = Field(primary_key=True)
+    pack_id: int = Field(index=True)
+    offset: int
+    length: int
+
+
+class IncidentRollup(SQLModel, table=True):
+    """Incident counts per (granularity, bucket, device, severity), see rollups.py."""
+    __table_args__ = (
+        UniqueConstraint("granularity", "bucket", "device_id", "severity", name="uq_rollup_key"),
+        Index("ix_rollup_device", "granularity", "device_id", "bucket"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    granularity: str
+    bucket: datetime
+    device_id: str
+    severity: str
+    count: int = 0
+    score_sum: float = 0.0
+    score_max: float = 0.0
@@ -0,0 +1,236 @@
+"""Packed archive tier for old thumbnails.
+
+Loose thumbnails not referenced by a new snapshot for PACK_AFTER are appended to large append-only
+pack files (``storage/packs/pack-*.pack``) and their loose copies removed,
+which keeps the inode count and backup cost of ``storage/thumbnails``
+bounded. The PackEntry table maps each thumbnail's original relpath to
+(pack, offset, length), so readers keep using the same relpath through
+`locate`/`read_blob`. Packs none of whose thumbnails was referenced within
+RETENTION are deleted wholesale together with their thumbnails and snapshots.
+
+Both jobs mutate blobs, so they run on the DB writer (see `db.run_write`),
+in small batches so ingestion can interleave. From the command line:
+
+    python packstore.py compact
+    python packstore.py retention
+"""
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from sqlalchemy import delete, func, or_, update
+from sqlmodel import Session, select
+
+import storage
+import thumbnails
+from db import engine
+from models import Pack, PackEntry, Snapshot, Thumbnail
+
+log = logging.getLogger(__name__)
+
+PACK_DIR = storage.BASE / "storage" / "packs"
+PACK_DIR.mkdir(parents=True, exist_ok=True)
+
+PACK_AFTER = timedelta(days=float(os.environ.get("SAFENET_PACK_AFTER_DAYS", "7")))
+RETENTION = timedelta(days=float(os.environ.get("SAFENET_PACK_RETENTION_DAYS", "365")))
+PACK_MAX_BYTES = int(os.environ.get("SAFENET_PACK_MAX_BYTES", 256 * 1024 * 1024))
+COMPACT_BATCH = 200
+
+
+class BlobLocation(NamedTuple):
+    path: Path
+    offset: int
+    length: int
+
+
+def locate(relpath: str, session: Optional[Session] = None) -> Optional[BlobLocation]:
+    """Where the bytes of thumbnail `relpath` live: its loose file or a pack slice."""
+    loose = storage.BASE / relpath
+    try:
+        return BlobLocation(loose, 0, loose.stat().st_size)
+    except FileNotFoundError:
+        pass
+    if session is None:
+        with Session(engine) as own:
+            return locate(relpath, own)
+    row = session.exec(
+        select(Pack.name, PackEntry.offset, PackEntry.length)
+        .join(Pack, Pack.id == PackEntry.pack_id)
+        .where(PackEntry.relpath == relpath)
+    ).first()
+    if row is None:
+        return None
+    return BlobLocation(PACK_DIR / row.name, row.offset, row.length)
+
+
+def read_location(loc: BlobLocation) -> bytes:
+    with open(loc.path, "rb") as f:
+        f.seek(loc.offset)
+        return f.read(loc.length)
+
+
+def read_blob(relpath: str) -> Optional[bytes]:
+    loc = locate(relpath)
+    return read_location(loc) if loc is not None else None
+
+
+def forget(session: Session, relpath: str) -> None:
+    """Drop the pack index entry of a deleted thumbnail (its bytes go with the pack)."""
+    session.exec(delete(PackEntry).where(PackEntry.relpath == relpath))
+
+
+def touch(session: Session, relpath: str, when: datetime) -> None:
+    """Keep the pack holding `relpath` (if any) alive for another RETENTION from `when`."""
+    pack_id = select(PackEntry.pack_id).where(PackEntry.relpath == relpath).scalar_subquery()
+    session.exec(
+        update(Pack)
+        .where(Pack.id == pack_id, or_(Pack.newest_blob_at.is_(None), Pack.newest_blob_at < when))
+        .values(newest_blob_at=when)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _open_pack(session: Session, now: datetime) -> Pack:
+    pack = session.exec(select(Pack).order_by(Pack.id.desc())).first()
+    if pack is None or pack.size >= PACK_MAX_BYTES:
+        pack = Pack(name=f"pack-{now:%Y%m%d-%H%M%S}-{os.getpid()}.pack", created_at=now, size=0)
+        session.add(pack)
+        session.flush()
+    return pack
+
+
+def compact_batch(older_than: timedelta = PACK_AFTER, limit: int = COMPACT_BATCH) -> int:
+    """Move up to `limit` loose thumbnails unreferenced for `older_than` into a pack.
+
+    The pack is appended and fsynced before the index commits, and loose
+    files are only removed after the commit, so a crash at any point leaves
+    every thumbnail readable. Thumbnail rows whose loose file has gone
+    missing are deleted with their snapshots (a later upload of that content
+    stores it again). Returns the number of rows handled, packed or deleted.
+    """
+    now = datetime.utcnow()
+    with Session(engine) as session:
+        session.exec(
+            update(Thumbnail)
+            .where(Thumbnail.last_referenced_at.is_(None))
+            .values(last_referenced_at=Thumbnail.created_at)
+            .execution_options(synchronize_session=False)
+        )
+        rows = session.exec(
+            select(Thumbnail.sha256, Thumbnail.relpath, Thumbnail.last_referenced_at)
+            .outerjoin(PackEntry, PackEntry.relpath == Thumbnail.relpath)
+            .where(Thumbnail.last_referenced_at < now - older_than, PackEntry.relpath.is_(None))
+            .order_by(Thumbnail.last_referenced_at)
+            .limit(limit)
+        ).all()
+        if not rows:
+            session.commit()
+            return 0
+
+        pack = _open_pack(session, now)
+        packed, missing = [], []
+        with open(PACK_DIR / pack.name, "ab") as out:
+            offset = out.seek(0, os.SEEK_END)
+            for sha256, relpath, referenced_at in rows:
+                loose = storage.BASE / relpath
+                try:
+                    data = loose.read_bytes()
+                except FileNotFoundError:
+                    missing.append(sha256)
+                    continue
+                out.write(data)
+                session.add(PackEntry(relpath=relpath, pack_id=pack.id, offset=offset, length=len(data)))
+                offset += len(data)
+                if pack.newest_blob_at is None or referenced_at > pack.newest_blob_at:
+                    pack.newest_blob_at = referenced_at
+                packed.append(loose)
+            out.flush()
+            os.fsync(out.fileno())
+        pack.size = offset
+        session.add(pack)
+        if missing:
+            # otherwise they stay the oldest unpacked rows and block every later batch
+            # their snapshots go too, so none is left pointing at a blob that no longer exists
+            log.warning("dropping %d thumbnails whose file is missing: %s", len(missing), ", ".join(missing[:10]))
+            session.exec(delete(Snapshot).where(Snapshot.sha256.in_(missing)))
+            session.exec(delete(Thumbnail).where(Thumbnail.sha256.in_(missing)))
+        session.commit()
+    for sha256 in missing:
+        thumbnails.purge_variants(sha256)
+
+    for loose in packed:
+        try:
+            os.remove(loose)
+        except FileNotFoundError:
+            pass
+    return len(packed) + len(missing)
+
+
+def compact(older_than: timedelta = PACK_AFTER) -> int:
+    total = 0
+    while True:
+        n = compact_batch(older_than)
+        total += n
+        if n == 0:
+            return total
+
+
+def expire_one_pack(retention: timedelta = RETENTION) -> Optional[str]:
+    """Delete the oldest pack none of whose thumbnails was referenced within `retention`.
+
+    Its thumbnails, their snapshots and the index entries go with it. Returns
+    the deleted pack's name, or None when nothing has expired.
+    """
+    cutoff = datetime.utcnow() - retention
+    with Session(engine) as session:
+        pack = session.exec(
+            select(Pack)
+            .where(Pack.newest_blob_at < cutoff, Pack.newest_blob_at.isnot(None))
+            .order_by(Pack.id)
+        ).first()
+        if pack is None:
+            return None
+        # the pack currently being filled is never expired
+        newest_pack_id = session.exec(select(func.max(Pack.id))).one()
+        if pack.id == newest_pack_id and pack.size < PACK_MAX_BYTES:
+            return None
+        relpaths = select(PackEntry.relpath).where(PackEntry.pack_id == pack.id)
+        shas = select(Thumbnail.sha256).where(Thumbnail.relpath.in_(relpaths))
+        expired_shas = session.exec(shas).all()
+        session.exec(delete(Snapshot).where(Snapshot.sha256.in_(shas)).execution_options(synchronize_session=False))
+        session.exec(delete(Thumbnail).where(Thumbnail.relpath.in_(relpaths)).execution_options(synchronize_session=False))
+        session.exec(delete(PackEntry).where(PackEntry.pack_id == pack.id))
+        name = pack.name
+        session.delete(pack)
+        session.commit()
+    try:
+        os.remove(PACK_DIR / name)
+    except FileNotFoundError:
+        pass
+    for sha256 in expired_shas:
+        thumbnails.purge_variants(sha256)
+    return name
+
+
+def apply_retention(retention: timedelta = RETENTION) -> int:
+    expired = 0
+    while expire_one_pack(retention):
+        expired += 1
+    return expired
+
+
+if __name__ == "__main__":
+    from db import init_db
+
+    init_db()
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "compact":
+        print(f"packed {compact()} thumbnails")
+    elif command == "retention":
+        print(f"deleted {apply_retention()} packs")
+    else:
+        print(__doc__)
+        sys.exit(2)
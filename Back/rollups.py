@@ -0,0 +1,165 @@
+"""Incrementally maintained incident rollups.
+
+Every incident bumps one IncidentRollup row per granularity (minute, hour
+and day) for its (device, severity). The ingest queue applies the bumps in
+the same transaction as the incidents themselves, so `/api/v1/stats` reads
+pre-aggregated rows instead of scanning Incident. Rollups live next to the
+incidents on each storage shard; `query` runs per shard and `merge` combines
+the partial results.
+
+Rebuild from the Incident table (with the API stopped, or it will race
+with ingestion):
+
+    python rollups.py rebuild
+"""
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session, select
+
+from db import shard_engines
+from models import Incident, IncidentRollup
+
+GRANULARITIES = ("minute", "hour", "day")
+GROUP_FIELDS = ("bucket", "device_id", "severity")
+
+RollupKey = Tuple[str, datetime, str, str]
+
+
+def bucket_start(ts: datetime, granularity: str) -> datetime:
+    # incidents are stored without tz offset, so bucket on the stored fields
+    ts = ts.replace(tzinfo=None)
+    if granularity == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"unknown granularity {granularity!r}")
+
+
+def accumulate(acc: Dict[RollupKey, List[float]], device_id: str, ts: datetime, severity: str, score: float) -> None:
+    """Add one incident to `acc`, keyed by rollup row, as [count, score_sum, score_max]."""
+    for granularity in GRANULARITIES:
+        key = (granularity, bucket_start(ts, granularity), device_id, severity)
+        row = acc.get(key)
+        if row is None:
+            acc[key] = [1, score, score]
+        else:
+            row[0] += 1
+            row[1] += score
+            if score > row[2]:
+                row[2] = score
+
+
+def apply(session: Session, acc: Dict[RollupKey, List[float]]) -> None:
+    """Upsert accumulated deltas; the caller owns the transaction."""
+    if not acc:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        insert, greatest = postgresql.insert, func.greatest
+    else:
+        insert, greatest = sqlite.insert, func.max
+    rows = [
+        {"granularity": g, "bucket": b, "device_id": d, "severity": s, "count": v[0], "score_sum": v[1], "score_max": v[2]}
+        for (g, b, d, s), v in acc.items()
+    ]
+    stmt = insert(IncidentRollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["granularity", "bucket", "device_id", "severity"],
+        set_={
+            "count": IncidentRollup.count + stmt.excluded["count"],
+            "score_sum": IncidentRollup.score_sum + stmt.excluded["score_sum"],
+            "score_max": greatest(IncidentRollup.score_max, stmt.excluded["score_max"]),
+        },
+    )
+    session.execute(stmt, rows)
+
+
+def query(session: Session, granularity: str, from_ts: Optional[datetime], to_ts: Optional[datetime],
+          device_id: Optional[str], severity: Optional[str], group_by: Iterable[str], limit: int) -> List[dict]:
+    """Partial aggregates (count, score_sum, max_score) of one shard, ordered by `group_by`."""
+    group_cols = [getattr(IncidentRollup, field) for field in group_by]
+    q = select(
+        *group_cols,
+        func.sum(IncidentRollup.count).label("incidents"),
+        func.sum(IncidentRollup.score_sum).label("score_sum"),
+        func.max(IncidentRollup.score_max).label("score_max"),
+    ).where(IncidentRollup.granularity == granularity)
+    if from_ts is not None:
+        q = q.where(IncidentRollup.bucket >= bucket_start(from_ts, granularity))
+    if to_ts is not None:
+        q = q.where(IncidentRollup.bucket <= to_ts.replace(tzinfo=None))
+    if device_id:
+        q = q.where(IncidentRollup.device_id == device_id)
+    if severity:
+        q = q.where(IncidentRollup.severity == severity)
+    if group_cols:
+        q = q.group_by(*group_cols).order_by(*group_cols)
+    out = []
+    for row in session.exec(q.limit(limit)):
+        if not row.incidents:
+            continue
+        item = {field: getattr(row, field) for field in group_by}
+        item.update(count=row.incidents, score_sum=row.score_sum, max_score=row.score_max)
+        out.append(item)
+    return out
+
+
+def merge(parts: Iterable[List[dict]], group_by: Iterable[str], limit: int) -> List[dict]:
+    """Combine per-shard `query` results into the first `limit` groups, with avg_score."""
+    group_by = list(group_by)
+    merged: Dict[tuple, dict] = {}
+    for part in parts:
+        for item in part:
+            key = tuple(item[field] for field in group_by)
+            seen = merged.get(key)
+            if seen is None:
+                merged[key] = dict(item)
+            else:
+                seen["count"] += item["count"]
+                seen["score_sum"] += item["score_sum"]
+                seen["max_score"] = max(seen["max_score"], item["max_score"])
+    out = []
+    for key in sorted(merged)[:limit]:
+        item = merged[key]
+        row = dict(zip(group_by, key))
+        if "bucket" in row:
+            row["bucket"] = row["bucket"].isoformat()
+        row.update(count=item["count"], avg_score=item["score_sum"] / item["count"], max_score=item["max_score"])
+        out.append(row)
+    return out
+
+
+def rebuild(chunk_size: int = 10000) -> int:
+    """Recompute every rollup row from Incident; returns the number of incidents read."""
+    return sum(rebuild_shard(engine, chunk_size) for engine in shard_engines)
+
+
+def rebuild_shard(engine, chunk_size: int = 10000) -> int:
+    acc: Dict[RollupKey, List[float]] = {}
+    seen = 0
+    with Session(engine) as session:
+        q = select(Incident.device_id, Incident.timestamp, Incident.severity, Incident.score)
+        for device_id, ts, severity, score in session.exec(q.execution_options(yield_per=chunk_size)):
+            accumulate(acc, device_id, ts, severity, score)
+            seen += 1
+    with Session(engine) as session:
+        session.exec(delete(IncidentRollup))
+        apply(session, acc)
+        session.commit()
+    return seen
+
+
+if __name__ == "__main__":
+    from db import init_db
+
+    init_db()
+    if sys.argv[1:] == ["rebuild"]:
+        print(f"rebuilt rollups from {rebuild()} incidents")
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -1,44 +1,351 @@
-from typing import Dict
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+RULES_FILE = Path(os.environ.get("SAFENET_RULES_FILE", Path(__file__).parent / "rules.json"))
+
+SEVERITY_LEVELS = ("none", "moderate", "high")
+
+# built-in ruleset, used when no rules file is present
+DEFAULT_RULES = {
+    "version": "builtin-1",
+    "driver": {"eye_closed_weight": 0.7, "distracted_weight": 0.8, "max_points": 50.0},
+    "vehicle": {"scale": 100.0, "max_points": 30.0},
+    "speed": {"threshold_kmh": 60.0, "full_kmh": 100.0, "max_points": 20.0},
+    # lower bound (inclusive) of every level after the first
+    "severity": {"moderate": 30.0, "high": 70.0},
+}
+
+
+class RuleSet:
+    """A rules definition compiled into plain float attributes.
+
+    The definition is validated once; scoring then only does arithmetic on
+    instance attributes, for single events (`score`) or NumPy columns
+    (`score_arrays`). Both paths apply the same operations in the same order,
+    so they return bit-identical results.
+    """
+
+    def __init__(self, definition: Dict):
+        try:
+            driver = definition["driver"]
+            vehicle = definition["vehicle"]
+            speed = definition["speed"]
+            severity = definition["severity"]
+            self.version = str(definition["version"])
+            self.eye_weight = float(driver["eye_closed_weight"])
+            self.distracted_weight = float(driver["distracted_weight"])
+            self.driver_points = float(driver["max_points"])
+            self.vehicle_scale = float(vehicle["scale"])
+            self.vehicle_points = float(vehicle["max_points"])
+            self.speed_threshold = float(speed["threshold_kmh"])
+            self.speed_span = float(speed["full_kmh"]) - self.speed_threshold
+            self.speed_points = float(speed["max_points"])
+            self.thresholds = (float(severity["moderate"]), float(severity["high"]))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise ValueError(f"invalid rules definition: {exc!r}")
+        if self.vehicle_scale <= 0 or self.speed_span <= 0:
+            raise ValueError("invalid rules definition: vehicle.scale and the speed ramp must be positive")
+        if self.thresholds[0] > self.thresholds[1]:
+            raise ValueError("invalid rules definition: severity thresholds must be ascending")
+        self.definition = definition
+        self._threshold_array = np.asarray(self.thresholds, dtype=np.float64)
+
+    def score(self, event: Dict) -> float:
+        """Risk score of one event; raises ValueError when its fields cannot be scored."""
+        eye_closed, distracted, vehicle_model_score, speed = event_features(event)
+        driver_score = min(1.0, eye_closed * self.eye_weight + distracted * self.distracted_weight) * self.driver_points
+
+        vehicle_score = min(self.vehicle_scale, vehicle_model_score) / self.vehicle_scale * self.vehicle_points
+
+        if speed <= self.speed_threshold:
+            speed_score = 0.0
+        else:
+            speed_score = min(self.speed_points, (speed - self.speed_threshold) / self.speed_span * self.speed_points)
+
+        score = driver_score + vehicle_score + speed_score
+        return max(0.0, min(100.0, score))
+
+    def score_arrays(self, eye_closed, distracted, vehicle_model_score, speed) -> np.ndarray:
+        eye_closed = np.asarray(eye_closed, dtype=np.float64)
+        distracted = np.asarray(distracted, dtype=np.float64)
+        vehicle_model_score = np.asarray(vehicle_model_score, dtype=np.float64)
+        speed = np.asarray(speed, dtype=np.float64)
+
+        # fmin/fmax return the non-NaN operand like the builtin min(const, x),
+        # so inf/nan inputs resolve exactly as in the scalar path
+        with np.errstate(invalid="ignore"):
+            driver_score = np.fmin(1.0, eye_closed * self.eye_weight + distracted * self.distracted_weight) * self.driver_points
+            vehicle_score = np.fmin(self.vehicle_scale, vehicle_model_score) / self.vehicle_scale * self.vehicle_points
+            speed_score = np.where(
+                speed <= self.speed_threshold,
+                0.0,
+                np.fmin(self.speed_points, (speed - self.speed_threshold) / self.speed_span * self.speed_points),
+            )
+
+            score = driver_score + vehicle_score + speed_score
+            return np.fmax(0.0, np.fmin(100.0, score))
+
+    def severity(self, score: float) -> str:
+        if score < self.thresholds[0]:
+            return SEVERITY_LEVELS[0]
+        if score < self.thresholds[1]:
+            return SEVERITY_LEVELS[1]
+        return SEVERITY_LEVELS[2]
+
+    def severity_codes(self, scores) -> np.ndarray:
+        """Index into SEVERITY_LEVELS for every score."""
+        return np.searchsorted(self._threshold_array, np.asarray(scores, dtype=np.float64), side="right")
+
+    def with_overrides(self, overrides: Dict) -> "RuleSet":
+        """Compile a copy of this ruleset with per-section `overrides` merged in."""
+        definition = copy.deepcopy(self.definition)
+        for section, values in overrides.items():
+            if isinstance(values, dict) and isinstance(definition.get(section), dict):
+                definition[section].update(values)
+        digest = hashlib.sha1(json.dumps(overrides, sort_keys=True).encode()).hexdigest()[:8]
+        definition["version"] = f"{self.version}+{digest}"
+        return RuleSet(definition)
+
+
+class RuleRegistry:
+    """Active ruleset loaded from a JSON file, hot-reloaded when it changes.
+
+    The file's mtime is checked at most every `check_interval` seconds, so
+    `current()`/`for_device()` stay a couple of dict lookups on the hot path.
+    A file that fails to load or validate is logged and the previous ruleset
+    is kept. Per-device overrides (the "rules" key of `Device.config`) are
+    compiled on first use and cached until the base ruleset changes; they
+    carry the device's config version so a periodic refresh from the
+    database (which picks up writes made by other processes) never replaces
+    them with an older config.
+    """
+
+    def __init__(self, path: Path, check_interval: float = 2.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._base = RuleSet(DEFAULT_RULES)
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._overrides: Dict[str, Dict] = {}
+        self._override_versions: Dict[str, int] = {}
+        self._compiled: Dict[str, RuleSet] = {}
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        if mtime is None:
+            ruleset = RuleSet(DEFAULT_RULES)
+        else:
+            try:
+                ruleset = RuleSet(json.loads(self.path.read_text()))
+            except (OSError, ValueError) as exc:
+                log.warning("keeping ruleset %s, failed to load %s: %s", self._base.version, self.path, exc)
+                self._mtime = mtime
+                return
+        with self._lock:
+            self._base = ruleset
+            self._mtime = mtime
+            self._compiled = {}
+        log.info("loaded ruleset %s", ruleset.version)
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._load()
+
+    def reload(self) -> RuleSet:
+        self._next_check = 0.0
+        self._maybe_reload()
+        return self._base
+
+    def current(self) -> RuleSet:
+        self._maybe_reload()
+        return self._base
+
+    def for_device(self, device_id: Optional[str]) -> RuleSet:
+        base = self.current()
+        if not device_id or device_id not in self._overrides:
+            return base
+        compiled = self._compiled.get(device_id)
+        if compiled is None:
+            compiled = base.with_overrides(self._overrides[device_id])
+            with self._lock:
+                if self._base is base:
+                    self._compiled[device_id] = compiled
+        return compiled
+
+    def validate_overrides(self, overrides: Optional[Dict]) -> None:
+        """Raise ValueError if `overrides` do not compile against the current ruleset."""
+        if overrides:
+            self._base.with_overrides(overrides)
+
+    def set_device_overrides(self, device_id: str, overrides: Optional[Dict], version: Optional[int] = None) -> None:
+        """Install (or clear, with a falsy value) rule overrides for one device.
+
+        With a config `version`, nothing changes unless it is newer than the
+        version of the overrides already installed.
+        """
+        if version is not None and self._override_versions.get(device_id, -1) >= version:
+            return
+        self.validate_overrides(overrides)
+        with self._lock:
+            if version is not None:
+                if self._override_versions.get(device_id, -1) >= version:
+                    return
+                self._override_versions[device_id] = version
+            if overrides:
+                self._overrides[device_id] = overrides
+            else:
+                self._overrides.pop(device_id, None)
+            self._compiled.pop(device_id, None)
+
+
+registry = RuleRegistry(RULES_FILE)
 
 
 def compute_risk(event: Dict) -> float:
     """Compute a simple risk score (0-100) from event payload.
 
-    This is a toy rules engine: weights are illustrative.
+    This is a toy rules engine: weights come from the active ruleset
+    (`rules.json`, see DEFAULT_RULES for the shape).
     - driver_state (eye_closed, distracted) -> up to 50
     - vehicle_model_score -> up to 30
     - telemetry (speed) -> up to 20
     """
-    score = 0.0
-    driver_state = event.get("driver_state", {}) or {}
-    eye_closed = float(driver_state.get("eye_closed", 0))
-    distracted = float(driver_state.get("distracted", 0))
+    return registry.current().score(event)
+
 
-    # driver contribution (50% max)
-    driver_score = min(1.0, eye_closed * 0.7 + distracted * 0.8) * 50.0
+def severity_from_score(score: float) -> str:
+    return registry.current().severity(score)
 
-    # vehicle model contribution (given as a score 0-100 interpreted as safety gap)
-    vehicle_model_score = float(event.get("vehicle_model_score", 0))
-    vehicle_score = min(100.0, vehicle_model_score) / 100.0 * 30.0
 
-    # telemetry contribution: speed over a threshold
-    telemetry = event.get("telemetry", {}) or {}
-    speed = float(telemetry.get("speed", 0))
-    if speed <= 60:
-        speed_score = 0.0
-    else:
-        # linearly scale 60->100 to 0->20
-        speed_score = min(20.0, (speed - 60) / 40.0 * 20.0)
+def _section(event: Dict, name: str) -> Dict:
+    section = event.get(name) or {}
+    if not isinstance(section, dict):
+        raise ValueError(f"{name} must be an object")
+    return section
 
-    score = driver_score + vehicle_score + speed_score
-    # clamp
-    score = max(0.0, min(100.0, score))
-    return score
 
+def _number(value, name: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name} must be a number") from None
 
-def severity_from_score(score: float) -> str:
-    if score < 30:
-        return "none"
-    if score < 70:
-        return "moderate"
-    return "high"
+
+def event_features(event: Dict) -> Tuple[float, float, float, float]:
+    """(eye_closed, distracted, vehicle_model_score, speed) of one event.
+
+    Raises ValueError when a section is not an object or a field is not a number.
+    """
+    if not isinstance(event, dict):
+        raise ValueError("event must be an object")
+    driver_state = _section(event, "driver_state")
+    telemetry = _section(event, "telemetry")
+    return (
+        _number(driver_state.get("eye_closed", 0), "driver_state.eye_closed"),
+        _number(driver_state.get("distracted", 0), "driver_state.distracted"),
+        _number(event.get("vehicle_model_score", 0), "vehicle_model_score"),
+        _number(telemetry.get("speed", 0), "telemetry.speed"),
+    )
+
+
+def extract_features(events: Iterable[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Pull the scored fields out of event payloads into float64 columns.
+
+    Returns (eye_closed, distracted, vehicle_model_score, speed); raises
+    ValueError like `event_features` for the first unusable event.
+    """
+    eye_closed, distracted, vehicle, speed = [], [], [], []
+    for event in events:
+        e, d, v, s = event_features(event)
+        eye_closed.append(e)
+        distracted.append(d)
+        vehicle.append(v)
+        speed.append(s)
+    return (
+        np.asarray(eye_closed, dtype=np.float64),
+        np.asarray(distracted, dtype=np.float64),
+        np.asarray(vehicle, dtype=np.float64),
+        np.asarray(speed, dtype=np.float64),
+    )
+
+
+def extract_features_tolerant(events: List[Dict]) -> Tuple[Tuple[np.ndarray, ...], List[int], Dict[int, str]]:
+    """`extract_features` that sets unusable events aside instead of raising.
+
+    Returns (the columns of the usable events, their indices in `events`,
+    {index: error} for the others).
+    """
+    eye_closed, distracted, vehicle, speed = [], [], [], []
+    usable, errors = [], {}
+    for idx, event in enumerate(events):
+        try:
+            e, d, v, s = event_features(event)
+        except ValueError as exc:
+            errors[idx] = str(exc)
+            continue
+        eye_closed.append(e)
+        distracted.append(d)
+        vehicle.append(v)
+        speed.append(s)
+        usable.append(idx)
+    columns = tuple(np.asarray(col, dtype=np.float64) for col in (eye_closed, distracted, vehicle, speed))
+    return columns, usable, errors
+
+
+def compute_risk_arrays(eye_closed, distracted, vehicle_model_score, speed, ruleset: Optional[RuleSet] = None) -> np.ndarray:
+    """Vectorized `compute_risk` over columnar inputs.
+
+    Every element is bit-identical to the scalar score of the equivalent event.
+    """
+    ruleset = ruleset or registry.current()
+    return ruleset.score_arrays(eye_closed, distracted, vehicle_model_score, speed)
+
+
+def severity_codes(scores, ruleset: Optional[RuleSet] = None) -> np.ndarray:
+    """Index into SEVERITY_LEVELS for every score."""
+    return (ruleset or registry.current()).severity_codes(scores)
+
+
+def severities_from_scores(scores, ruleset: Optional[RuleSet] = None) -> List[str]:
+    levels = np.asarray(SEVERITY_LEVELS, dtype=object)
+    return levels[severity_codes(scores, ruleset)].tolist()
+
+
+def compute_risk_batch(events: List[Dict], ruleset: Optional[RuleSet] = None) -> Tuple[List[float], List[str]]:
+    """Score many events in one pass; same results as compute_risk/severity_from_score."""
+    ruleset = ruleset or registry.current()
+    scores = ruleset.score_arrays(*extract_features(events))
+    return scores.tolist(), severities_from_scores(scores, ruleset)
+
+
+def compute_risk_batch_tolerant(events: List[Dict], ruleset: Optional[RuleSet] = None
+                                ) -> Tuple[List[int], List[float], List[str], Dict[int, str]]:
+    """`compute_risk_batch` that scores the usable events and reports the rest.
+
+    Returns (indices of the scored events, their scores, their severities,
+    {index: error} for the events whose fields cannot be scored).
+    """
+    ruleset = ruleset or registry.current()
+    features, usable, errors = extract_features_tolerant(events)
+    scores = ruleset.score_arrays(*features)
+    return usable, scores.tolist(), severities_from_scores(scores, ruleset), errors
@@ -1,29 +1,127 @@
+"""Content-addressed thumbnail store.
+
+Every thumbnail is stored once, under its sha256, in a two-level sharded
+layout: ``storage/thumbnails/ab/cd/abcd...``. Uploads are streamed into
+``storage/thumbnails/incoming`` first; `store_blob` then moves them into place
+or, when the content is already stored, just drops the temporary copy.
+Reference counting (how many snapshots share a blob) lives in the database,
+see the Thumbnail model.
+"""
+import hashlib
+import inspect
 import os
+import re
+import uuid
 from pathlib import Path
-from typing import Tuple
+from typing import NamedTuple, Tuple
+
+import aiofiles
+import aiofiles.os
 
 
-BASE = Path(__file__).parent
+# root of the storage/ tree; relpaths stored in the database are relative to it
+BASE = Path(os.environ.get("SAFENET_STORAGE_DIR", Path(__file__).parent))
 THUMB_DIR = BASE / "storage" / "thumbnails"
-THUMB_DIR.mkdir(parents=True, exist_ok=True)
+INCOMING_DIR = THUMB_DIR / "incoming"
+INCOMING_DIR.mkdir(parents=True, exist_ok=True)
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("SAFENET_MAX_UPLOAD_BYTES", 5 * 1024 * 1024))
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"upload exceeds {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+class Upload(NamedTuple):
+    tmp_path: Path
+    size: int
+    sha256: str
+
+
+def _relpath(path: Path) -> str:
+    return os.path.relpath(path, BASE).replace("\\", "/")
+
+
+def is_sha256(value: str) -> bool:
+    return bool(SHA256_RE.match(value or ""))
+
+
+def blob_path(sha256: str) -> Path:
+    return THUMB_DIR / sha256[:2] / sha256[2:4] / sha256
 
 
-async def save_thumbnail(file, filename: str) -> Tuple[str, int]:
-    """Save an UploadFile-like object to thumbnails directory.
+def blob_relpath(sha256: str) -> str:
+    return _relpath(blob_path(sha256))
 
-    Returns (relative_path, size_bytes)
+
+async def _read_chunk(file, size: int) -> bytes:
+    # UploadFile.read is a coroutine; plain file-likes (SpooledTemporaryFile) are sync
+    data = file.read(size)
+    if inspect.isawaitable(data):
+        data = await data
+    return data
+
+
+async def stream_upload(file, max_bytes: int = MAX_UPLOAD_BYTES) -> Upload:
+    """Stream an UploadFile-like object to a temporary file, hashing it on the way.
+
+    The upload is copied in CHUNK_SIZE pieces with non-blocking writes, so
+    memory use does not depend on the file size. Raises UploadTooLarge (and
+    keeps nothing on disk) once more than `max_bytes` have been read. Pass
+    the result to `store_blob` or `discard_upload`.
+    """
+    tmp = INCOMING_DIR / f"{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp, "wb") as out:
+            while True:
+                chunk = await _read_chunk(file, CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        try:
+            await aiofiles.os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return Upload(tmp, size, digest.hexdigest())
+
+
+def store_blob(upload: Upload) -> Tuple[str, bool]:
+    """Move an upload to its content address.
+
+    Returns (relative_path, created); `created` is False when identical
+    content was already stored, in which case the upload is simply dropped.
+    Callers serialise this with `delete_blob` (both run on the DB writer).
     """
-    dest = THUMB_DIR / filename
-    # file is an UploadFile (async) or SpooledTemporaryFile; handle both
+    dest = blob_path(upload.sha256)
+    if dest.exists():
+        discard_upload(upload)
+        return _relpath(dest), False
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(upload.tmp_path, dest)
+    return _relpath(dest), True
+
+
+def discard_upload(upload: Upload) -> None:
     try:
-        content = await file.read()
-    except Exception:
-        # fallback for sync file-like
-        file.seek(0)
-        content = file.read()
+        os.remove(upload.tmp_path)
+    except FileNotFoundError:
+        pass
 
-    with open(dest, "wb") as f:
-        f.write(content)
 
-    rel = os.path.relpath(dest, BASE)
-    return rel.replace("\\", "/"), dest.stat().st_size
+def delete_blob(sha256: str) -> None:
+    try:
+        os.remove(blob_path(sha256))
+    except FileNotFoundError:
+        pass
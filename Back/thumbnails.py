@@ -0,0 +1,179 @@
+"""Serving thumbnails: conditional/range responses and resized variants.
+
+Blobs are content-addressed, so the sha256 is a natural strong ETag and a
+served representation never changes. Resized variants are rendered with
+Pillow in a process pool (keeping the event loop and the GIL free) and
+cached on disk under ``storage/variants/ab/<sha256>-<size>.jpg``.
+"""
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import aiofiles
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+import storage
+
+VARIANT_DIR = storage.BASE / "storage" / "variants"
+VARIANT_DIR.mkdir(parents=True, exist_ok=True)
+
+# longest edge, in pixels, of the variants the API will render
+VARIANT_SIZES = (80, 160, 320, 640)
+VARIANT_WORKERS = int(os.environ.get("SAFENET_VARIANT_WORKERS", "2"))
+CHUNK_SIZE = 64 * 1024
+
+_pool: Optional[ProcessPoolExecutor] = None
+_rendering: Dict[Tuple[str, int], "asyncio.Future"] = {}
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def variant_path(sha256: str, size: int) -> Path:
+    return VARIANT_DIR / sha256[:2] / f"{sha256}-{size}.jpg"
+
+
+def purge_variants(sha256: str) -> None:
+    """Remove cached variants of a deleted thumbnail."""
+    for size in VARIANT_SIZES:
+        try:
+            os.remove(variant_path(sha256, size))
+        except FileNotFoundError:
+            pass
+
+
+def render_variant(data: bytes, size: int) -> bytes:
+    """Downscale image bytes so the longest edge is `size`; runs in a worker process."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((size, size))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=80, optimize=True)
+        return out.getvalue()
+
+
+def _write_variant(dest: Path, data: bytes) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + ".part")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dest)
+
+
+async def get_variant(sha256: str, size: int, source: bytes) -> Path:
+    """Path of the cached `size` variant, rendering it first if needed.
+
+    Concurrent requests for the same variant share one render.
+    """
+    global _pool
+    dest = variant_path(sha256, size)
+    if dest.exists():
+        return dest
+    key = (sha256, size)
+    pending = _rendering.get(key)
+    if pending is None:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=VARIANT_WORKERS)
+        loop = asyncio.get_running_loop()
+        pending = loop.create_task(_render(loop, dest, source, size))
+        _rendering[key] = pending
+        pending.add_done_callback(lambda _: _rendering.pop(key, None))
+    await asyncio.shield(pending)
+    return dest
+
+
+async def _render(loop, dest: Path, source: bytes, size: int) -> None:
+    data = await loop.run_in_executor(_pool, render_variant, source, size)
+    await loop.run_in_executor(None, _write_variant, dest, data)
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, as RFC 9110 requires for If-None-Match
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return any(c[2:] == etag if c.startswith("W/") else c == etag for c in candidates)
+
+
+def parse_range(header: Optional[str], length: int) -> Optional[Tuple[int, int]]:
+    """Resolve a single `bytes=` range to (start, end_inclusive).
+
+    Returns None to serve the whole body (no header, an unsupported unit or
+    several ranges); raises RangeNotSatisfiable for ranges outside the body.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    spec = header[len("bytes="):].strip()
+    start_raw, _, end_raw = spec.partition("-")
+    try:
+        if start_raw == "":
+            suffix = int(end_raw)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(spec)
+            return max(0, length - suffix), length - 1
+        start = int(start_raw)
+        end = int(end_raw) if end_raw else length - 1
+    except ValueError:
+        return None
+    if start >= length or end < start:
+        raise RangeNotSatisfiable(spec)
+    return start, min(end, length - 1)
+
+
+class BlobResponse(Response):
+    """Send `length` bytes of `path` starting at `offset`.
+
+    Uses the ASGI zero-copy send extension (the server sendfile()s straight
+    from the file descriptor) when the server offers it, and otherwise
+    streams the slice in CHUNK_SIZE reads.
+    """
+
+    def __init__(self, path: Path, offset: int, length: int, status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None, media_type: Optional[str] = None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD" or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(),
+                            "offset": self.offset, "count": self.length, "more_body": False})
+            return
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})